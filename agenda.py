@@ -0,0 +1,46 @@
+import heapq, itertools
+
+class Agenda(object):
+    """Pending rule activations of a KnowledgeBase that infers incrementally. An
+        activation is a fact that may match the first LHS statement of a rule,
+        or that a transitive closure joins on behalf of its rule;
+        activations of rules with a higher priority are run first, and in the
+        order they were added among rules of the same priority.
+
+    Attributes:
+        heap (listof tuple): (-priority, sequence number, fact, rule) entries
+    """
+    def __init__(self):
+        """Constructor for Agenda with no pending activations
+        """
+        super(Agenda, self).__init__()
+        self.heap = []
+        self._sequence = itertools.count()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Agenda({!r} activations)'.format(len(self.heap))
+
+    def __len__(self):
+        """Define behavior of len, the number of pending activations
+        """
+        return len(self.heap)
+
+    def push(self, fact, rule):
+        """Add an activation
+
+        Args:
+            fact (Fact): fact to match against the rule
+            rule (Rule): rule activated, with its priority
+        """
+        heapq.heappush(self.heap, (-rule.priority, next(self._sequence), fact, rule))
+
+    def pop(self):
+        """Remove the activation to run next
+
+        Returns:
+            (Fact, Rule)
+        """
+        entry = heapq.heappop(self.heap)
+        return entry[2], entry[3]
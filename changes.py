@@ -0,0 +1,228 @@
+import threading, time
+from util import match
+
+class Change(object):
+    """Represents one delta in the change stream of a KnowledgeBase: a fact that
+        was added to or removed from the KB
+
+    Attributes:
+        offset (int): position of the change in the stream
+        op (str): 'add' or 'remove'
+        fact (Fact): the fact added or removed
+        bindings (Bindings|None): bindings of the subscription pattern to the
+            fact, set on the changes a Subscription delivers
+    """
+    def __init__(self, offset, op, fact, bindings=None):
+        """Constructor for Change
+
+        Args:
+            offset (int): position of the change in the stream
+            op (str): 'add' or 'remove'
+            fact (Fact): the fact added or removed
+            bindings (Bindings|None): bindings of a subscription pattern
+        """
+        super(Change, self).__init__()
+        self.offset = offset
+        self.op = op
+        self.fact = fact
+        self.bindings = bindings
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Change({!r}, {!r}, {!r})'.format(self.offset, self.op, self.fact.statement)
+
+    def __str__(self):
+        """Define external representation when printed
+        """
+        return "{} {} {}".format(self.offset, self.op, self.fact.statement)
+
+class ChangeLog(object):
+    """Ordered log of the facts added to and removed from a KnowledgeBase.
+        Changes are retained until every subscription has committed past them.
+        With a capacity, a writer that would grow the backlog of the slowest
+        subscription beyond it waits up to timeout seconds for consumers to
+        catch up; a subscription still lagging after that is marked overflowed
+        and stops holding back the log.
+
+    Attributes:
+        entries (listof Change): retained changes, in order
+        start (int): offset of the first retained change
+        end (int): offset the next change will get
+        live (setof tuple): keys of the facts the stream has reported as added
+            and not yet removed
+        subscriptions (listof Subscription): active subscriptions
+        capacity (int|None): maximum backlog of a subscription
+        timeout (float): seconds a writer waits for a lagging subscription
+        condition (Condition): signalled whenever changes are added or committed
+    """
+    def __init__(self, capacity=None, timeout=1.0):
+        """Constructor for ChangeLog
+
+        Args:
+            capacity (int|None): maximum backlog of a subscription, None for no limit
+            timeout (float): seconds a writer waits for a lagging subscription
+        """
+        super(ChangeLog, self).__init__()
+        self.entries = []
+        self.start = 0
+        self.end = 0
+        self.live = set()
+        self.subscriptions = []
+        self.capacity = capacity
+        self.timeout = timeout
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ChangeLog(offsets {!r}..{!r}, {!r} subscriptions)'.format(
+                self.start, self.end, len(self.subscriptions))
+
+    def publish(self, op, fact):
+        """Append a change to the log. Facts that are evicted and re-derived
+            are not reported again.
+
+        Args:
+            op (str): 'add' or 'remove'
+            fact (Fact): the fact added or removed
+        """
+        key = fact.key()
+        if op == 'add':
+            if key in self.live:
+                return
+            self.live.add(key)
+        else:
+            if key not in self.live:
+                return
+            self.live.discard(key)
+        with self.condition:
+            if self.capacity is not None:
+                deadline = time.time() + self.timeout
+                while self._lagging() and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                for subscription in self._lagging():
+                    subscription.overflowed = True
+                    self.subscriptions.remove(subscription)
+            self._trim()
+            self.entries.append(Change(self.end, op, fact))
+            self.end += 1
+            self.condition.notify_all()
+
+    def read(self, offset, max_items=None):
+        """Retained changes from offset on
+
+        Args:
+            offset (int): offset of the first change to return
+            max_items (int|None): maximum number of changes to return
+
+        Returns:
+            listof Change
+        """
+        with self.condition:
+            first = max(offset, self.start) - self.start
+            last = len(self.entries) if max_items is None else first + max_items
+            return self.entries[first:last]
+
+    def _lagging(self):
+        """INTERNAL USE ONLY
+        Subscriptions whose backlog is at capacity
+        """
+        return [s for s in self.subscriptions if self.end - s.committed >= self.capacity]
+
+    def _trim(self):
+        """INTERNAL USE ONLY
+        Drop the changes every subscription has committed
+        """
+        if self.subscriptions:
+            keep_from = min(s.committed for s in self.subscriptions)
+        else:
+            keep_from = self.end
+        if keep_from > self.start:
+            del self.entries[:keep_from - self.start]
+            self.start = keep_from
+
+class Subscription(object):
+    """A consumer of the changes to the facts matching a pattern. Changes are
+        polled in order and in batches; the offset of the last change processed
+        is committed so it can be resumed from, e.g. after a restart.
+
+    Attributes:
+        log (ChangeLog): log the changes are read from
+        pattern (Statement): statement the facts of delivered changes match
+        position (int): offset of the next change to poll
+        committed (int): offset up to which changes have been processed
+        batch_size (int|None): default maximum number of changes per poll
+        overflowed (bool): flag set when the subscription fell too far behind
+            and changes were dropped; it has to be resubscribed
+    """
+    def __init__(self, log, pattern, offset, batch_size=None):
+        """Constructor for Subscription
+
+        Args:
+            log (ChangeLog): log the changes are read from
+            pattern (Statement): statement the facts of delivered changes match
+            offset (int): offset to start at
+            batch_size (int|None): default maximum number of changes per poll
+        """
+        super(Subscription, self).__init__()
+        self.log = log
+        self.pattern = pattern
+        self.overflowed = offset < log.start
+        self.position = max(offset, log.start)
+        self.committed = self.position
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Subscription({!r}, {!r})'.format(self.pattern, self.position)
+
+    def poll(self, max_items=None, timeout=0):
+        """Get the next batch of changes to facts matching the pattern
+
+        Args:
+            max_items (int|None): maximum number of changes to scan, defaults to
+                batch_size
+            timeout (float): seconds to wait for changes if there are none yet
+
+        Returns:
+            listof Change: matching changes, with bindings of the pattern
+        """
+        max_items = max_items if max_items is not None else self.batch_size
+        log = self.log
+        with log.condition:
+            if self.position >= log.end and timeout:
+                log.condition.wait(timeout)
+            changes = log.read(self.position, max_items)
+        batch = []
+        for change in changes:
+            bindings = match(self.pattern, change.fact.statement)
+            if bindings:
+                batch.append(Change(change.offset, change.op, change.fact, bindings))
+        if changes:
+            self.position = changes[-1].offset + 1
+        return batch
+
+    def commit(self, offset=None):
+        """Mark the changes before offset as processed so they can be released
+
+        Args:
+            offset (int|None): offset of the first unprocessed change, defaults
+                to everything polled so far
+        """
+        log = self.log
+        with log.condition:
+            self.committed = max(self.committed, self.position if offset is None else offset)
+            log._trim()
+            log.condition.notify_all()
+
+    def close(self):
+        """Stop the subscription, releasing the changes it holds back
+        """
+        log = self.log
+        with log.condition:
+            if self in log.subscriptions:
+                log.subscriptions.remove(self)
+            log._trim()
+            log.condition.notify_all()
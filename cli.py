@@ -0,0 +1,200 @@
+"""Batch runner: load statement files (or a snapshot of a saturated KB), run
+    query files against it in a pool of worker processes and write the answers
+    as JSONL, one line per query, e.g.
+
+    python cli.py statements_kb4.txt --queries queries.txt --workers 4 --output answers.jsonl
+"""
+import argparse, json, os, sys, time
+import read
+from logical_classes import *
+from student_code import KnowledgeBase
+
+_kb = None
+
+def load(paths):
+    """Parse statement files
+
+    Args:
+        paths (listof str): files of facts and rules, as read by read.read_tokenize
+
+    Returns:
+        listof Fact|Rule
+    """
+    elements = []
+    for path in paths:
+        elements.extend(read.read_tokenize(path))
+    return elements
+
+def saturate(elements, kb=None):
+    """Assert facts and rules, inferring everything that follows from them
+
+    Args:
+        elements (listof Fact|Rule): facts and rules to assert
+        kb (KnowledgeBase|None): KB to assert into, a new one if None
+
+    Returns:
+        KnowledgeBase
+    """
+    kb = KnowledgeBase() if kb is None else kb
+    for element in elements:
+        kb.kb_assert(element)
+    return kb
+
+def save_snapshot(kb, path):
+    """Write a saturated KB to a file
+
+    Args:
+        kb (KnowledgeBase): KB to save
+        path (str): file to write
+    """
+    import pickle
+    with open(path, 'wb') as file:
+        pickle.dump(kb, file, pickle.HIGHEST_PROTOCOL)
+
+def load_snapshot(path):
+    """Read a KB written by save_snapshot
+
+    Args:
+        path (str): file to read
+
+    Returns:
+        KnowledgeBase
+    """
+    import pickle
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def _init_worker(kb):
+    """INTERNAL USE ONLY
+    Pool initializer installing the KB queries run against. Workers don't print
+    the trace of kb_ask
+    """
+    global _kb
+    _kb = kb
+    sys.stdout = open(os.devnull, 'w')
+
+def run_query(job):
+    """Answer one query against the KB installed by _init_worker
+
+    Args:
+        job ((int, str, str)): index, file and statement of the query
+
+    Returns:
+        dict: the result written as a line of JSONL
+    """
+    index, source, statement = job
+    started = time.perf_counter()
+    answer = _kb.kb_ask(Fact(Statement(statement.split())))
+    latency = time.perf_counter() - started
+    return {
+        'index': index,
+        'file': source,
+        'query': '(' + statement + ')',
+        'answers': [dict(bindings.bindings_dict) for bindings in answer],
+        'latency_ms': round(latency * 1000, 3),
+    }
+
+def read_queries(paths):
+    """Queries of query files, facts in the syntax of statement files, e.g.
+        fact: (grandmotherof ada ?X)
+
+    Args:
+        paths (listof str): query files
+
+    Returns:
+        listof (int, str, str): index, file and statement of every query
+    """
+    jobs = []
+    for path in paths:
+        for element in read.read_tokenize(path):
+            if isinstance(element, Fact):
+                statement = element.statement
+                terms = [statement.predicate] + [str(term) for term in statement.terms]
+                jobs.append((len(jobs), path, ' '.join(terms)))
+            else:
+                print("Skipping rule in query file:", path, file=sys.stderr)
+    return jobs
+
+def percentile(values, fraction):
+    """Value below which the given fraction of sorted values lie
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def main(argv=None):
+    """Entry point of the batch runner
+
+    Args:
+        argv (listof str|None): command line arguments, sys.argv[1:] if None
+
+    Returns:
+        int: exit status
+    """
+    global _kb
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('statements', nargs='*', help='statement files to load')
+    parser.add_argument('--snapshot', help='load a saturated KB saved with --save-snapshot '
+                        'before the statement files')
+    parser.add_argument('--save-snapshot', help='save the saturated KB to this file')
+    parser.add_argument('--queries', nargs='*', default=[], help='query files to run')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='worker processes running queries, 0 to run them in this process')
+    parser.add_argument('--chunksize', type=int, default=64,
+                        help='queries handed to a worker at a time')
+    parser.add_argument('--output', help='JSONL file to write answers to, stdout by default')
+    args = parser.parse_args(argv)
+    if not args.statements and not args.snapshot:
+        parser.error('nothing to load: pass statement files or --snapshot')
+
+    started = time.time()
+    kb = load_snapshot(args.snapshot) if args.snapshot else None
+    elements = load(args.statements)
+    load_time = time.time() - started
+
+    started = time.time()
+    kb = saturate(elements, kb)
+    saturation_time = time.time() - started
+    if args.save_snapshot:
+        save_snapshot(kb, args.save_snapshot)
+
+    jobs = read_queries(args.queries)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    latencies = []
+    started = time.time()
+    try:
+        if args.workers > 0 and jobs:
+            import multiprocessing
+            pool = multiprocessing.Pool(args.workers, _init_worker, (kb,))
+            results = pool.imap(run_query, jobs, args.chunksize)
+        else:
+            pool = None
+            _kb = kb
+            results = (run_query(job) for job in jobs)
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            for result in results:
+                latencies.append(result['latency_ms'])
+                output.write(json.dumps(result) + '\n')
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            else:
+                sys.stdout.close()
+                sys.stdout = stdout
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    query_time = time.time() - started
+
+    latencies.sort()
+    print("load {:.3f}s, saturation {:.3f}s: {} facts, {} rules".format(
+            load_time, saturation_time, len(kb.facts), len(kb.rules)), file=sys.stderr)
+    print("{} queries in {:.3f}s, latency ms p50 {:.3f} p95 {:.3f} p99 {:.3f} max {:.3f}".format(
+            len(latencies), query_time, percentile(latencies, 0.5), percentile(latencies, 0.95),
+            percentile(latencies, 0.99), latencies[-1] if latencies else 0.0), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+"""Differential testing of KnowledgeBase configurations against a reference
+    engine, with per-operation timings and a performance regression gate.
+
+    Randomized traces of asserts, retracts and asks, some of the asserted
+    facts containing variables, are run against a naive reference engine,
+    which recomputes the fixpoint of the asserted facts and rules from
+    scratch, and against every engine configuration. Any difference
+    in the answers to asks, in the facts held, in which facts are asserted, or
+    in the justifications (supported_by) recorded by a configuration compared
+    to the default KnowledgeBase is reported as a divergence. Constructing
+    each engine is timed as the 'construct' operation, and the cold start,
+    importing student_code and constructing a KnowledgeBase in a fresh
+    interpreter, is gated against an explicit budget, e.g.
+
+    python harness.py --seeds 200 --engines default count_only agenda --save-baseline timings.json
+    python harness.py --seeds 200 --baseline timings.json --tolerance 1.5
+    python harness.py --seeds 0 --startup-budget 0.1
+"""
+import argparse, contextlib, copy, io, json, os, random, subprocess, sys, time
+import read
+from logical_classes import *
+from util import match_keys, instantiate_key
+from student_code import KnowledgeBase
+from storage import SqliteFactStore
+
+# seconds allowed for importing student_code and constructing a KnowledgeBase
+STARTUP_BUDGET = 0.25
+
+PREDICATES = ['p', 'q', 'r', 's']
+CONSTANTS = ['a', 'b', 'c', 'd', 'e']
+RULES = [
+    "rule: ((p ?x ?y)) -> (r ?x ?y)",
+    "rule: ((r ?x a) (q a ?y)) -> (s ?x ?y)",
+    "rule: ((p ?x ?y) (q ?y ?z)) -> (r ?x ?z)",
+    "rule: ((q ?x ?y) (q ?y ?z)) -> (q ?x ?z)",
+    "rule: ((p ?x ?y) (q ?y ?z)) -> (p ?x ?z)",
+    "rule: ((r ?x ?y) (s ?y ?x)) -> (s ?x ?y)",
+    "rule: ((s ?x ?y) (p ?y ?z) (q ?z ?x)) -> (r ?z ?z)",
+]
+
+class ReferenceKB(object):
+    """Naive engine defining the expected behavior: the facts of the KB are
+        the fixpoint of the asserted facts under the asserted rules, recomputed
+        after every change. Every fact is matched against the first LHS
+        statement of every rule, both of which may contain variables, and the
+        rest of the rule is curried, as forward chaining does. A retracted fact
+        stays as long as it can still be derived, but is no longer asserted.
+
+    Attributes:
+        asserted (listof tuple): keys of the asserted facts, in order
+        rules (listof (listof tuple, tuple)): LHS and RHS keys of the asserted rules
+        facts (setof tuple): keys of the facts of the fixpoint
+    """
+    def __init__(self):
+        """Constructor for an empty ReferenceKB
+        """
+        super(ReferenceKB, self).__init__()
+        self.asserted = []
+        self.rules = []
+        self.facts = set()
+
+    def _saturate(self):
+        facts = list(dict.fromkeys(self.asserted))
+        rules = list(dict.fromkeys((tuple(lhs), rhs) for lhs, rhs in self.rules))
+        known = set(facts) | set(rules)
+        tried = set()
+        changed = True
+        while changed:
+            changed = False
+            for rule in list(rules):
+                lhs, rhs = rule
+                for key in list(facts):
+                    if (rule, key) in tried:
+                        continue
+                    tried.add((rule, key))
+                    bindings = match_keys(key, lhs[0])
+                    if bindings is None:
+                        continue
+                    rest = tuple(instantiate_key(statement, bindings) for statement in lhs[1:])
+                    derived = (rest, instantiate_key(rhs, bindings)) if rest else instantiate_key(rhs, bindings)
+                    if derived not in known:
+                        known.add(derived)
+                        (rules if rest else facts).append(derived)
+                        changed = True
+        self.facts = set(facts)
+
+    def kb_assert(self, fact_rule):
+        if isinstance(fact_rule, Fact):
+            if fact_rule.key() not in self.asserted:
+                self.asserted.append(fact_rule.key())
+        else:
+            rule = ([s.key() for s in fact_rule.lhs], fact_rule.rhs.key())
+            if rule not in self.rules:
+                self.rules.append(rule)
+        self._saturate()
+
+    def kb_retract(self, fact_rule):
+        if isinstance(fact_rule, Fact):
+            if fact_rule.key() in self.asserted:
+                self.asserted.remove(fact_rule.key())
+                self._saturate()
+        else:
+            rule = ([s.key() for s in fact_rule.lhs], fact_rule.rhs.key())
+            if rule in self.rules:
+                self.rules.remove(rule)
+                self._saturate()
+
+    def kb_ask(self, fact):
+        pattern = fact.key()
+        return [bindings for bindings in (match_keys(pattern, key) for key in sorted(self.facts))
+                if bindings is not None]
+
+def _rematerialize_all(kb):
+    """INTERNAL USE ONLY
+    Bring back everything a KB with a budget evicted, so it can be compared
+    """
+    visited = set()
+    for predicate in list(kb.partial):
+        if predicate not in visited:
+            kb._rematerialize(predicate, visited)
+
+# name => (factory, hook run after every operation to let the engine settle)
+ENGINES = {
+    'default': (lambda: KnowledgeBase(), None),
+    'count_only': (lambda: KnowledgeBase(count_only=True), None),
+    'budget': (lambda: KnowledgeBase(budget=2), lambda kb: _rematerialize_all(kb)),
+    'versioned': (lambda: KnowledgeBase(versioned=True), None),
+    'agenda': (lambda: KnowledgeBase(agenda=True), lambda kb: kb.kb_run()),
+    # a cache this small keeps rebuilding facts from their rows
+    'sqlite': (lambda: KnowledgeBase(backend=SqliteFactStore(':memory:', cache_size=4)), None),
+}
+
+def register(name, factory, settle=None):
+    """Add an engine configuration to compare, e.g. a new backend
+
+    Args:
+        name (str): name to report the engine under
+        factory (callable): returns a new, empty engine with the KnowledgeBase
+            interface (kb_assert, kb_retract, kb_ask, facts)
+        settle (callable|None): called with the engine after every operation,
+            before it is compared
+    """
+    ENGINES[name] = (factory, settle)
+
+def trace(seed, length=40, rules=RULES):
+    """Randomized trace of operations
+
+    Args:
+        seed (int): seed of the trace
+        length (int): number of operations
+        rules (listof str): rules to draw asserted rules from
+
+    Returns:
+        listof (str, Fact|Rule): ('assert'|'retract'|'ask', statement)
+    """
+    rnd = random.Random(seed)
+    asserted = []
+    ops = []
+
+    def random_fact(variables=False, name='v'):
+        terms = [rnd.choice(CONSTANTS[:3]), rnd.choice(CONSTANTS)]
+        if variables:
+            terms = [t if rnd.random() < 0.5 else '?{}{}'.format(name, i)
+                     for i, t in enumerate(terms)]
+        return "fact: ({} {})".format(rnd.choice(PREDICATES), ' '.join(terms))
+
+    for _ in range(length):
+        x = rnd.random()
+        if x < 0.45:
+            # some asserted facts hold for any value of an argument
+            text = random_fact(variables=rnd.random() < 0.1, name='u')
+            asserted.append(text)
+            ops.append(('assert', text))
+        elif x < 0.55:
+            ops.append(('assert', rnd.choice(rules)))
+        elif x < 0.6:
+            ops.append(('retract', rnd.choice(rules)))
+        elif x < 0.75:
+            # mostly retract something that was asserted
+            text = rnd.choice(asserted) if asserted and rnd.random() < 0.8 else random_fact()
+            ops.append(('retract', text))
+        else:
+            ops.append(('ask', random_fact(variables=True)))
+    return [(op, read.parse_input(text)) for op, text in ops]
+
+def _answers(answer):
+    """INTERNAL USE ONLY
+    Answers of kb_ask as a sorted list of binding dicts
+    """
+    answers = []
+    for bindings in answer or []:
+        answers.append(bindings if isinstance(bindings, dict) else dict(bindings.bindings_dict))
+    return sorted(answers, key=lambda b: sorted(b.items()))
+
+def _justifications(kb):
+    """INTERNAL USE ONLY
+    Canonical form of the supported_by state of a KnowledgeBase, the premises
+    of each justification as a set since a fact can be joined with itself
+    """
+    state = {}
+    for fact_rule in kb.facts + kb.rules:
+        state[fact_rule.key()] = sorted(tuple(sorted(set(str(p.key()) for p in pair)))
+                                       for pair in fact_rule.supported_by)
+    return state
+
+class Report(object):
+    """Outcome of a harness run
+
+    Attributes:
+        divergences (listof str): description of every divergence found
+        timings (dictof str: dictof str: listof float): per engine and
+            operation, seconds taken by every operation
+        traces (int): number of traces run
+    """
+    def __init__(self):
+        super(Report, self).__init__()
+        self.divergences = []
+        self.timings = {}
+        self.traces = 0
+
+    def __repr__(self):
+        return 'Report({!r} traces, {!r} divergences)'.format(self.traces, len(self.divergences))
+
+    def summary(self):
+        """Mean and 95th percentile milliseconds per engine and operation
+
+        Returns:
+            dictof str: dictof str: [float, float, int] - [mean, p95, count]
+        """
+        summary = {}
+        for engine, ops in self.timings.items():
+            for op, times in ops.items():
+                times = sorted(times)
+                summary.setdefault(engine, {})[op] = [
+                    1000 * sum(times) / len(times),
+                    1000 * times[min(len(times) - 1, int(0.95 * len(times)))],
+                    len(times)]
+        return summary
+
+    def regressions(self, baseline, tolerance):
+        """Operations whose mean time grew beyond tolerance times the baseline
+
+        Args:
+            baseline (dict): summary() of an earlier run
+            tolerance (float): allowed slowdown factor
+
+        Returns:
+            listof str
+        """
+        regressions = []
+        for engine, ops in self.summary().items():
+            for op, (mean, p95, count) in ops.items():
+                before = baseline.get(engine, {}).get(op)
+                if before and mean > before[0] * tolerance:
+                    regressions.append("{} {}: {:.3f}ms, baseline {:.3f}ms".format(
+                            engine, op, mean, before[0]))
+        return regressions
+
+def run(seeds, engines=None, length=40, compare_supports=True, rules=RULES):
+    """Run randomized traces against the reference engine and the engines
+
+    Args:
+        seeds (iterable of int): seeds of the traces to run
+        engines (listof str|None): names of registered engines, all if None
+        length (int): operations per trace
+        compare_supports (bool): compare supported_by against the default
+            KnowledgeBase after every operation
+        rules (listof str): rules to draw asserted rules from
+
+    Returns:
+        Report
+    """
+    engines = list(engines or ENGINES)
+    report = Report()
+    for seed in seeds:
+        report.traces += 1
+        reference = ReferenceKB()
+        kbs = {}
+        for name in engines:
+            # construction is timed like any operation, as 'construct'
+            started = time.perf_counter()
+            kbs[name] = ENGINES[name][0]()
+            elapsed = time.perf_counter() - started
+            report.timings.setdefault(name, {}).setdefault('construct', []).append(elapsed)
+        control = KnowledgeBase() if compare_supports else None
+        failed = set()
+        ops = trace(seed, length, rules)
+        # every KB gets its own facts and rules, whose asserted flags it sets
+        copies = dict((name, copy.deepcopy(ops)) for name in engines)
+        controls = copy.deepcopy(ops)
+        for step, (op, item) in enumerate(ops):
+            expected = getattr(reference, 'kb_' + op)(item)
+            if control is not None:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    getattr(control, 'kb_' + op)(controls[step][1])
+            for name in engines:
+                if name in failed:
+                    continue
+                kb = kbs[name]
+                item = copies[name][step][1]
+                settle = ENGINES[name][1]
+                with contextlib.redirect_stdout(io.StringIO()):
+                    started = time.perf_counter()
+                    answer = getattr(kb, 'kb_' + op)(item)
+                    if settle is not None:
+                        settle(kb)
+                    elapsed = time.perf_counter() - started
+                report.timings.setdefault(name, {}).setdefault(op, []).append(elapsed)
+                where = "seed {} step {} {} {} on {}".format(seed, step, op, item.statement
+                        if isinstance(item, Fact) else item.key(), name)
+                problem = None
+                if op == 'ask' and _answers(answer) != _answers(expected):
+                    problem = "answers {} != expected {}".format(_answers(answer), _answers(expected))
+                elif set(f.key() for f in kb.facts) != reference.facts:
+                    got = set(f.key() for f in kb.facts)
+                    problem = "facts missing {} extra {}".format(
+                            sorted(reference.facts - got), sorted(got - reference.facts))
+                elif (set(f.key() for f in kb.facts if f.asserted) !=
+                      set(reference.asserted) & reference.facts):
+                    problem = "asserted facts {} != expected {}".format(
+                            sorted(f.key() for f in kb.facts if f.asserted), sorted(reference.asserted))
+                elif (control is not None and hasattr(kb, 'store') and
+                      set(f.key() for f in control.facts) == reference.facts and
+                      _justifications(kb) != _justifications(control)):
+                    problem = "supported_by differs from the default KnowledgeBase"
+                if problem:
+                    report.divergences.append(where + ": " + problem)
+                    failed.add(name)
+    return report
+
+def startup_time(runs=3):
+    """Seconds taken to import student_code and construct a KnowledgeBase in a
+        fresh interpreter, the best of several runs
+
+    Args:
+        runs (int): number of interpreters started
+
+    Returns:
+        float
+    """
+    code = ("import time; started = time.perf_counter(); import student_code; "
+            "student_code.KnowledgeBase(); print(time.perf_counter() - started)")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.check_output([sys.executable, '-c', code], cwd=directory))
+               for run in range(runs))
+
+def main(argv=None):
+    """Entry point of the harness
+
+    Args:
+        argv (listof str|None): command line arguments, sys.argv[1:] if None
+
+    Returns:
+        int: exit status, 1 if there were divergences or regressions, or if
+            the cold start exceeded its budget
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seeds', type=int, default=100, help='number of traces')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--length', type=int, default=40, help='operations per trace')
+    parser.add_argument('--engines', nargs='*', choices=sorted(ENGINES), help='engines to test')
+    parser.add_argument('--baseline', help='JSON timings of an earlier run to gate against')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='allowed slowdown factor over the baseline')
+    parser.add_argument('--save-baseline', help='write the timings of this run as JSON')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET,
+                        help='seconds allowed for the cold start, 0 to skip it')
+    args = parser.parse_args(argv)
+
+    report = run(range(args.first_seed, args.first_seed + args.seeds), args.engines, args.length)
+    for divergence in report.divergences:
+        print("DIVERGENCE", divergence)
+    summary = report.summary()
+    for engine, ops in sorted(summary.items()):
+        for op, (mean, p95, count) in sorted(ops.items()):
+            print("{:<12} {:<8} {:>6} ops mean {:.3f}ms p95 {:.3f}ms".format(
+                    engine, op, count, mean, p95))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = report.regressions(json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(summary, file, indent=1, sort_keys=True)
+    slow_start = False
+    if args.startup_budget:
+        startup = startup_time()
+        print("startup {:.3f}s budget {:.3f}s".format(startup, args.startup_budget))
+        slow_start = startup > args.startup_budget
+        if slow_start:
+            print("REGRESSION startup: {:.3f}s, budget {:.3f}s".format(startup, args.startup_budget))
+    return 1 if report.divergences or regressions or slow_start else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
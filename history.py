@@ -0,0 +1,147 @@
+import bisect, threading, time
+
+class History(object):
+    """Multi-version record of the facts a KnowledgeBase held. Every assert and
+        retract is a transaction with its own version number, and every fact is
+        tagged with the interval of versions [begin, end) it was part of the KB,
+        so the KB can be asked about any retained version without copying it.
+        Old versions are garbage collected with collect, possibly from a
+        background thread (see start_collector).
+
+    Attributes:
+        version (int): version of the transaction being written, or the last one
+        committed (int): last version whose transaction has finished
+        oldest (int): oldest version that can still be asked about
+        records (dictof str: listof list): per predicate, [fact, begin, end]
+            records where end is None while the fact is still in the KB
+        current (dictof tuple: list): open record of each fact in the KB, by key
+        times (listof (float, int)): (timestamp, version) of every transaction
+        lock (RLock): held by writers and the garbage collector
+    """
+    def __init__(self):
+        """Constructor for History starting at version 0
+        """
+        super(History, self).__init__()
+        self.version = 0
+        self.committed = 0
+        self.oldest = 0
+        self.records = {}
+        self.current = {}
+        self.times = [(time.time(), 0)]
+        self.lock = threading.RLock()
+        self._collector = None
+        self._stopping = threading.Event()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'History(versions {!r}..{!r})'.format(self.oldest, self.committed)
+
+    def begin(self):
+        """Start a new transaction, the caller has to hold lock
+
+        Returns:
+            int: version of the transaction
+        """
+        self.version += 1
+        self.times.append((time.time(), self.version))
+        return self.version
+
+    def commit(self):
+        """Make the current transaction visible to readers
+        """
+        self.committed = self.version
+
+    def added(self, fact):
+        """Record that a fact became part of the KB in the current version
+
+        Args:
+            fact (Fact): fact added to the KB
+        """
+        key = fact.key()
+        if key in self.current:
+            return
+        record = [fact, self.version, None]
+        self.records.setdefault(fact.statement.predicate, []).append(record)
+        self.current[key] = record
+
+    def removed(self, fact):
+        """Record that a fact stopped being part of the KB in the current version
+
+        Args:
+            fact (Fact): fact removed from the KB
+        """
+        record = self.current.pop(fact.key(), None)
+        if record is not None:
+            record[2] = self.version
+
+    def facts_at(self, predicate, version):
+        """Facts with the given predicate that were part of the KB at version
+
+        Args:
+            predicate (str): predicate of the facts
+            version (int): retained version
+
+        Returns:
+            listof Fact
+        """
+        return [fact for fact, begin, end in self.records.get(predicate, [])
+                if begin <= version and (end is None or version < end)]
+
+    def version_at(self, timestamp):
+        """Last version committed at or before a point in time
+
+        Args:
+            timestamp (float): seconds since the epoch, as returned by time.time()
+
+        Returns:
+            int
+        """
+        index = bisect.bisect_right(self.times, (timestamp, float('inf'))) - 1
+        return min(self.times[max(index, 0)][1], self.committed)
+
+    def collect(self, keep_from):
+        """Garbage collect the versions before keep_from
+
+        Args:
+            keep_from (int): oldest version to retain
+        """
+        with self.lock:
+            keep_from = min(keep_from, self.committed)
+            if keep_from <= self.oldest:
+                return
+            for predicate, records in list(self.records.items()):
+                kept = [r for r in records if r[2] is None or r[2] > keep_from]
+                if kept:
+                    self.records[predicate] = kept
+                else:
+                    del self.records[predicate]
+            self.times = [t for t in self.times if t[1] >= keep_from] or self.times[-1:]
+            self.oldest = keep_from
+
+    def start_collector(self, interval, keep):
+        """Garbage collect in a background thread every interval seconds,
+            retaining the last keep versions
+
+        Args:
+            interval (float): seconds between collections
+            keep (int): number of versions to retain
+        """
+        self.stop_collector()
+        self._stopping.clear()
+
+        def run():
+            while not self._stopping.wait(interval):
+                self.collect(self.committed - keep)
+
+        self._collector = threading.Thread(target=run, name="kb-history-gc")
+        self._collector.daemon = True
+        self._collector.start()
+
+    def stop_collector(self):
+        """Stop the background garbage collector, if running
+        """
+        if self._collector is not None:
+            self._stopping.set()
+            self._collector.join()
+            self._collector = None
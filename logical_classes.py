@@ -1,4 +1,4 @@
-from util import is_var
+import weakref
 
 class Fact(object):
     """Represents a fact in our knowledge base. Has a statement containing the
@@ -14,8 +14,10 @@ class Fact(object):
             the statement
         supports_facts (listof Fact): Facts that this fact supports
         supports_rules (listof Rule): Rules that this fact supports
+        ident (int|None): ID of this fact in the SupportStore of its KB
+        store (SupportStore|None): store holding the justifications of this fact
     """
-    def __init__(self, statement, supported_by=[]):
+    def __init__(self, statement, supported_by=None):
         """Constructor for Fact setting up useful flags and generating appropriate statement
 
         Args:
@@ -28,12 +30,44 @@ class Fact(object):
         self.name = "fact"
         self.statement = statement if isinstance(statement, Statement) else Statement(statement)
         self.asserted = not supported_by
-        #self.supported_by = supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-           self.supported_by.append(pair)
+        self.ident = None
+        self.store = None
+        self._supported_by = list(supported_by) if supported_by else []
+
+    @property
+    def supported_by(self):
+        """Justifications of this fact, materialized from the SupportStore of the
+            KB holding it or the ones it was constructed with if it isn't in a KB
+        """
+        if self.store is not None:
+            return self.store.supported_by(self)
+        return self._supported_by or []
+
+    @property
+    def supports_facts(self):
+        """Facts that this fact supports
+        """
+        if self.store is None:
+            return []
+        return [fr for fr in self.store.supports(self) if isinstance(fr, Fact)]
+
+    @property
+    def supports_rules(self):
+        """Rules that this fact supports
+        """
+        if self.store is None:
+            return []
+        return [fr for fr in self.store.supports(self) if isinstance(fr, Rule)]
+
+    def release_supports(self):
+        """Hand over the justifications this fact was constructed with, used
+            when it is registered with a SupportStore
+
+        Returns:
+            listof listof Fact|Rule
+        """
+        pending, self._supported_by = self._supported_by or [], None
+        return pending
 
     def __repr__(self):
         """Define internal string representation
@@ -73,6 +107,11 @@ class Fact(object):
         """
         return not self == other
 
+    def key(self):
+        """Canonical form of this fact, usable as a dictionary key
+        """
+        return self.statement.key()
+
 class Rule(object):
     """Represents a rule in our knowledge base. Has a list of statements (the LHS)
         containing the statements that need to be in our KB for us to infer the
@@ -89,8 +128,12 @@ class Rule(object):
             the statement
         supports_facts (listof Fact): Facts that this rule supports
         supports_rules (listof Rule): Rules that this rule supports
+        ident (int|None): ID of this rule in the SupportStore of its KB
+        store (SupportStore|None): store holding the justifications of this rule
+        priority (int): activations of rules with a higher priority are run
+            first by a KB with an agenda
     """
-    def __init__(self, rule, supported_by=[]):
+    def __init__(self, rule, supported_by=None, priority=0):
         """Constructor for Rule setting up useful flags and generating appropriate LHS & RHS
 
         Args:
@@ -98,17 +141,52 @@ class Rule(object):
                 RHS of this rule
             supported_by (listof Fact|Rule): Facts/Rules that allow inference of
                 the statement
+            priority (int): priority of the activations of this rule
         """
         super(Rule, self).__init__()
         self.name = "rule"
         self.lhs = [statement if isinstance(statement, Statement) else Statement(statement) for statement in rule[0]]
         self.rhs = rule[1] if isinstance(rule[1], Statement) else Statement(rule[1])
         self.asserted = not supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-            self.supported_by.append(pair)
+        self.ident = None
+        self.store = None
+        self.priority = priority
+        self._supported_by = list(supported_by) if supported_by else []
+
+    @property
+    def supported_by(self):
+        """Justifications of this rule, materialized from the SupportStore of the
+            KB holding it or the ones it was constructed with if it isn't in a KB
+        """
+        if self.store is not None:
+            return self.store.supported_by(self)
+        return self._supported_by or []
+
+    @property
+    def supports_facts(self):
+        """Facts that this rule supports
+        """
+        if self.store is None:
+            return []
+        return [fr for fr in self.store.supports(self) if isinstance(fr, Fact)]
+
+    @property
+    def supports_rules(self):
+        """Rules that this rule supports
+        """
+        if self.store is None:
+            return []
+        return [fr for fr in self.store.supports(self) if isinstance(fr, Rule)]
+
+    def release_supports(self):
+        """Hand over the justifications this rule was constructed with, used
+            when it is registered with a SupportStore
+
+        Returns:
+            listof listof Fact|Rule
+        """
+        pending, self._supported_by = self._supported_by or [], None
+        return pending
 
     def __repr__(self):
         """Define internal string representation
@@ -152,19 +230,53 @@ class Rule(object):
         """
         return not self == other
 
+    def key(self):
+        """Canonical form of this rule, usable as a dictionary key
+        """
+        return (tuple(statement.key() for statement in self.lhs), self.rhs.key())
+
 class Statement(object):
     """Represents a statement in our knowledge base, e.g. (attacked Ai Nosliw),
         (diamonds Loot), (isa Sorceress Wizard), etc. These statements show up
         in Facts or on the LHS and RHS of Rules
 
+        Statements are hash-consed: constructing a statement equal to one that
+        already exists returns the existing instance, so equal statements are
+        the same object, compare by identity and share their terms. Statements
+        must therefore not be modified after construction.
+
     Attributes:
         terms (listof Term): List of terms (Variable or Constant) in the
             statement, e.g. 'Nosliw' or '?d'
         predicate (str): The predicate of the statement, e.g. isa, hero, needs
     """
-    def __init__(self, statement_list=[]):
-        """Constructor for Statements with optional list of Statements that are
-            converted to appropriate terms (and one predicate)
+    # canonical form => the live Statement with that form
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, statement_list=None):
+        """Get the Statement for a list of a predicate and terms, creating it
+            only if no equal statement exists
+
+        Args:
+            statement_list (mostly listof str|Term, first element is str): The element at
+                index 0 is the predicate of the statement (a str) while the rest of
+                the list is either instantiated Terms or strings to be passed to the
+                Term constructor
+        """
+        statement_list = list(statement_list) if statement_list else [""]
+        key = (statement_list[0],) + tuple(str(t) for t in statement_list[1:])
+        statement = cls._interned.get(key)
+        if statement is None:
+            statement = super(Statement, cls).__new__(cls)
+            statement.predicate = statement_list[0]
+            statement.terms = [t if isinstance(t, Term) else Term(t) for t in statement_list[1:]]
+            statement._key = key
+            statement._hash = hash(key)
+            statement = cls._interned.setdefault(key, statement)
+        return statement
+
+    def __init__(self, statement_list=None):
+        """Constructor for Statements, see __new__
 
         Args:
             statement_list (mostly listof str|Term, first element is str): The element at
@@ -173,12 +285,11 @@ class Statement(object):
                 Term constructor
         """
         super(Statement, self).__init__()
-        self.terms = []
-        self.predicate = ""
 
-        if statement_list:
-            self.predicate = statement_list[0]
-            self.terms = [t if isinstance(t, Term) else Term(t) for t in statement_list[1:]]
+    def __reduce__(self):
+        """Define pickling, re-interning the statement when it is loaded
+        """
+        return (Statement, (list(self._key),))
 
     def __repr__(self):
         """Define internal string representation
@@ -191,21 +302,26 @@ class Statement(object):
         return "(" + self.predicate + " " + ' '.join((str(t) for t in self.terms)) + ")"
 
     def __eq__(self, other):
-        """Define behavior of == when applied to this object
+        """Define behavior of == when applied to this object, equal statements
+            being the same instance
         """
-        if self.predicate != other.predicate:
-            return False
-
-        for self_term, other_term in zip(self.terms, other.terms):
-            if self_term != other_term:
-                return False
-
-        return True
+        return self is other
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
-        return not self == other
+        return self is not other
+
+    def __hash__(self):
+        """Define behavior of hash, precomputed from the canonical form
+        """
+        return self._hash
+
+    def key(self):
+        """Canonical form of this statement, e.g. ('isa', 'cube', '?x'), usable
+            as a dictionary key
+        """
+        return self._key
 
 class Term(object):
     """Represents a term (a Variable or Constant) in our knowledge base. Can
@@ -224,7 +340,7 @@ class Term(object):
         """
         super(Term, self).__init__()
         is_var_or_const = isinstance(term, Variable) or isinstance(term, Constant)
-        self.term = term if is_var_or_const else (Variable(term) if is_var(term) else Constant(term))
+        self.term = term if is_var_or_const else (Variable(term) if term[0] == "?" else Constant(term))
 
     def __repr__(self):
         """Define internal string representation
@@ -278,9 +394,9 @@ class Variable(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.element == other.term.element
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.element == other.element))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
@@ -316,9 +432,9 @@ class Constant(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.element == other.term.element
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.element == other.element))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
@@ -412,7 +528,7 @@ class Bindings(object):
         if variable.element in self.bindings_dict.keys():
             value = self.bindings_dict[variable.element]
             if value:
-                return Variable(value) if is_var(value) else Constant(value)
+                return Variable(value) if value[0] == "?" else Constant(value)
 
         return False
 
@@ -476,7 +592,7 @@ class ListOfBindings(object):
         """
         return self.list_of_bindings[key][0]
 
-    def add_bindings(self, bindings, facts_rules=[]):
+    def add_bindings(self, bindings, facts_rules=None):
         """Add given bindings to list of Bindings along with associated rules or facts
 
             Args:
@@ -486,4 +602,4 @@ class ListOfBindings(object):
             Returns:
                 Nothing
         """
-        self.list_of_bindings.append((bindings, facts_rules))
+        self.list_of_bindings.append((bindings, facts_rules if facts_rules is not None else []))
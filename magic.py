@@ -0,0 +1,129 @@
+"""Magic-sets rewriting of the rules of a KB for a set of expected queries, so
+    that forward chaining only derives the facts relevant to them.
+
+    For a query like (grandmotherof ada ?X) the rules concluding grandmotherof
+    get a guard, a first LHS statement (magic_grandmotherof_bf ada), so they
+    only fire for the bound arguments that were asked about. Magic rules pass
+    the bindings on, left to right, to the rules concluding the predicates in
+    their LHS, e.g.
+        ((magic_grandmotherof_bf ?z) (motherof ?z ?x)) -> (magic_parentof_bf ?x)
+    LHS statements are reordered so bound arguments are passed on as early as
+    possible. Rules that cannot contribute to any of the queries are dropped. The
+    predicates of conclusions are not renamed, so the rewritten KB is asked
+    about exactly like the original one.
+"""
+from logical_classes import *
+from util import is_var
+
+def adornment(statement, bound):
+    """Binding pattern of a statement: 'b' for every argument that is a constant
+        or a bound variable, 'f' for the free ones
+
+    Args:
+        statement (tuple): statement key, e.g. ('grandmotherof', 'ada', '?X')
+        bound (setof str): variables already bound
+
+    Returns:
+        str
+    """
+    return ''.join('f' if is_var(term) and term not in bound else 'b'
+                   for term in statement[1:])
+
+def magic_statement(statement, adorned):
+    """Magic statement carrying the bound arguments of a statement
+
+    Args:
+        statement (tuple): statement key
+        adorned (str): adornment of the statement
+
+    Returns:
+        list: statement as a list of str, e.g. ['magic_grandmotherof_bf', 'ada']
+    """
+    return (['magic_{}_{}'.format(statement[0], adorned)] +
+            [term for term, a in zip(statement[1:], adorned) if a == 'b'])
+
+def _order(body, bound):
+    """INTERNAL USE ONLY
+    Order LHS statements so that each one has as many arguments bound by the
+    ones before it as possible, passing the bindings of the query on as early
+    as possible
+    """
+    bound = set(bound)
+    remaining = list(body)
+    ordered = []
+    while remaining:
+        best = max(remaining, key=lambda statement: adornment(statement, bound).count('b'))
+        remaining.remove(best)
+        ordered.append(best)
+        bound.update(term for term in best[1:] if is_var(term))
+    return ordered
+
+def magic_seed(query):
+    """Fact to assert into a rewritten KB so that it derives the answers of
+        another query with the same adornment as one it was rewritten for
+
+    Args:
+        query (Fact): query, e.g. (grandmotherof ada ?X)
+
+    Returns:
+        Fact: e.g. (magic_grandmotherof_bf ada)
+    """
+    key = query.key()
+    return Fact(magic_statement(key, adornment(key, set())))
+
+def magic_rewrite(elements, queries):
+    """Rewrite the rules of a KB for a set of expected queries
+
+    Args:
+        elements (listof Fact|Rule): facts and rules of the KB, e.g. as returned
+            by read.read_tokenize
+        queries (listof Fact): patterns that will be asked about
+
+    Returns:
+        listof Fact|Rule: the facts, the seeds of the queries, and the guarded
+            and magic rules, to be asserted into a KnowledgeBase
+    """
+    facts = [element for element in elements if isinstance(element, Fact)]
+    rules = [element for element in elements if isinstance(element, Rule)]
+    derived = set(rule.rhs.predicate for rule in rules)
+
+    rewritten = []
+    seen = set()
+    pending = []
+    for query in queries:
+        key = query.key()
+        if key[0] in derived:
+            seed = magic_seed(query)
+            if seed.key() not in seen:
+                seen.add(seed.key())
+                rewritten.append(seed)
+            pending.append((key[0], adornment(key, set())))
+
+    done = set()
+    while pending:
+        predicate, adorned = pending.pop()
+        if (predicate, adorned) in done:
+            continue
+        done.add((predicate, adorned))
+        for rule in rules:
+            head = rule.rhs.key()
+            if head[0] != predicate or len(head) - 1 != len(adorned):
+                continue
+            guard = magic_statement(head, adorned)
+            bound = set(term for term, a in zip(head[1:], adorned) if a == 'b' and is_var(term))
+            prefix = [guard] if 'b' in adorned else []
+            for body in _order([statement.key() for statement in rule.lhs], bound):
+                if body[0] in derived:
+                    body_adorned = adornment(body, bound)
+                    pending.append((body[0], body_adorned))
+                    if 'b' in body_adorned:
+                        magic = magic_statement(body, body_adorned)
+                        if prefix:
+                            rewritten.append(Rule([list(prefix), magic]))
+                        else:
+                            rewritten.append(Fact(magic))
+                prefix.append(list(body))
+                bound.update(term for term in body[1:] if is_var(term))
+            rewritten.append(Rule([prefix, list(head)]))
+
+    return facts + rewritten
@@ -1,7 +1,33 @@
 import unittest
+import contextlib, io, json, os, pickle, shutil, subprocess, sys, tempfile, time
 import read, copy
 from logical_classes import *
+from util import match, instantiate
 from student_code import KnowledgeBase
+from overlay import KnowledgeBaseOverlay
+from sharded import ShardedKnowledgeBase
+import cli
+from magic import magic_rewrite
+from storage import SqliteFactStore
+import harness
+
+def load_kb(file='statements_kb4.txt', kb=None, **options):
+    """Assert the facts and rules of a statements file
+
+    Args:
+        file (str): statements file to read
+        kb (KnowledgeBase|None): KB to assert into, a new
+            KnowledgeBase(**options) if None
+
+    Returns:
+        the KB
+    """
+    if kb is None:
+        kb = KnowledgeBase(**options)
+    for item in read.read_tokenize(file):
+        if isinstance(item, Fact) or isinstance(item, Rule):
+            kb.kb_assert(item)
+    return kb
 
 class KBTest(unittest.TestCase):
 
@@ -59,7 +85,7 @@ class KBTest(unittest.TestCase):
         self.assertEqual(str(answer[1]), "?X : chen")
 
     def test5(self):
-        # makes sure retract does not deal with rules
+        # makes sure retracting a rule removes what was derived through it
         ask1 = read.parse_input("fact: (parentof ada ?X)")
         print(' Asking if', ask1)
         answer = self.KB.kb_ask(ask1)
@@ -69,6 +95,13 @@ class KBTest(unittest.TestCase):
         self.KB.kb_retract(r1)
         print(' Asking if', ask1)
         answer = self.KB.kb_ask(ask1)
+        self.assertEqual(answer, [])
+        ask2 = read.parse_input("fact: (grandmotherof ada ?X)")
+        print(' Asking if', ask2)
+        answer = self.KB.kb_ask(ask2)
+        self.assertEqual([str(b) for b in answer], ["?X : felix"])
+        self.KB.kb_assert(read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)"))
+        answer = self.KB.kb_ask(ask1)
         self.assertEqual(str(answer[0]), "?X : bing")
 
 
@@ -162,6 +195,692 @@ class KBTest(unittest.TestCase):
         answer = self.KB.kb_ask(ask3)
         self.assertEqual(str(answer[0]), "?X : profHammond")
         
+    def test11(self):
+        """re-deriving facts already in the KB only adds justifications to the
+        existing instances
+        """
+        count = len(self.KB.facts)
+        suppressed = self.KB.suppressed
+        a1 = read.parse_input("rule: ((motherof ?a ?b)) -> (parentof ?a ?b)")
+        print(' Asserting', a1)
+        self.KB.kb_assert(a1)
+        self.assertEqual(len(self.KB.facts), count)
+        self.assertEqual(self.KB.suppressed, suppressed + 4)
+        fact = self.KB._get_fact(read.parse_input("fact: (parentof ada bing)"))
+        self.assertEqual(len(fact.supported_by), 2)
+
+    def test12(self):
+        """only rules whose first LHS statement could match a fact are tried"""
+        fact1 = read.parse_input("fact: (sisters ada eva)")
+        rules = self.KB._rules_for(fact1)
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(str(rules[0].lhs[0]), "(sisters ada ?z)")
+        self.assertEqual(self.KB._rules_for(read.parse_input("fact: (sisters zed eva)")), [])
+        self.assertEqual(self.KB._rules_for(read.parse_input("fact: (color ada red)")), [])
+
+    def test13(self):
+        """facts with a variable first argument reach rules and are reached by
+        rules whose first LHS statement has a constant there
+        """
+        self.KB.kb_assert(read.parse_input("rule: ((isa b ?z)) -> (kind a ?z)"))
+        self.KB.kb_assert(read.parse_input("rule: ((inst ?x ?y) (likes ?y ?z)) -> (kind ?x ?z)"))
+        self.KB.kb_assert(read.parse_input("fact: (inst a b)"))
+        self.KB.kb_assert(read.parse_input("fact: (isa ?q c)"))
+        self.KB.kb_assert(read.parse_input("fact: (likes ?q d)"))
+        answer = self.KB.kb_ask(read.parse_input("fact: (kind a ?Z)"))
+        self.assertEqual([str(b) for b in answer], ["?Z : c", "?Z : d"])
+        # facts are looked up by their first argument too
+        self.KB.kb_assert(read.parse_input("fact: (likes e f)"))
+        facts = self.KB._facts_for(read.parse_input("fact: (likes b ?z)").statement)
+        self.assertEqual([str(f.statement) for f in facts], ["(likes ?q d)"])
+
+
+
+class ClosureTest(unittest.TestCase):
+
+    def setUp(self):
+        # statements_kb.txt holds the recursive (inst ?x ?y) (isa ?y ?z) rule
+        self.KB = load_kb('statements_kb.txt')
+
+    def test1(self):
+        # the transitive rule is evaluated without currying intermediate rules
+        self.KB.kb_assert(read.parse_input("fact: (isa block shape)"))
+        ask1 = read.parse_input("fact: (inst cube1 ?X)")
+        answer = self.KB.kb_ask(ask1)
+        self.assertEqual([str(b) for b in answer], ["?X : cube", "?X : block", "?X : shape"])
+        self.assertEqual(len(self.KB.rules), 5)
+        derived = self.KB._get_fact(read.parse_input("fact: (inst cube1 shape)"))
+        self.assertEqual([str(x.name) for x in derived.supported_by[0]], ["fact", "fact", "rule"])
+
+    def test2(self):
+        # retracting an edge removes everything reached through it
+        self.KB.kb_assert(read.parse_input("fact: (isa block shape)"))
+        self.KB.kb_retract(read.parse_input("fact: (isa cube block)"))
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (inst cube1 shape)")))
+        answer = self.KB.kb_ask(read.parse_input("fact: (inst pyramid1 shape)"))
+        self.assertEqual(str(answer[0]), "No bindings")
+
+    def test3(self):
+        # facts with variables join like they would through the curried rules
+        self.KB.kb_assert(read.parse_input("fact: (inst a b)"))
+        self.KB.kb_assert(read.parse_input("fact: (isa ?q c)"))
+        answer = self.KB.kb_ask(read.parse_input("fact: (inst a ?Z)"))
+        self.assertEqual([str(b) for b in answer], ["?Z : b", "?Z : c"])
+        derived = self.KB._get_fact(read.parse_input("fact: (inst a c)"))
+        self.assertEqual([str(f.statement) for f in self.KB.kb_explain(derived)[0][:2]],
+                         ["(inst a b)", "(isa ?q c)"])
+        self.KB.kb_retract(read.parse_input("fact: (isa ?q c)"))
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (inst a c)")))
+
+
+class CountOnlyTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest, but only support counts are recorded
+        self.KB = load_kb(count_only=True)
+
+    def test1(self):
+        # justifications are recomputed when asked for
+        fact = self.KB._get_fact(read.parse_input("fact: (grandmotherof ada chen)"))
+        self.assertFalse(self.KB.store.justifications)
+        self.assertEqual(self.KB.store.count(fact), 1)
+        self.assertEqual(len(fact.supported_by), 1)
+        self.assertEqual(str(fact.supported_by[0][0].statement), "(motherof ada bing)")
+
+    def test2(self):
+        # counts alone are enough to retract
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        answer = self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.assertEqual(len(answer), 1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+
+    def test3(self):
+        # rematerializing doesn't count the justifications left in the KB twice
+        KB = KnowledgeBase([], [], count_only=True, budget=2)
+        for op, item in harness.trace(16):
+            if op == 'assert':
+                KB.kb_assert(item)
+            elif op == 'retract':
+                KB.kb_retract(item)
+        harness._rematerialize_all(KB)
+        for fact_rule in KB.facts + KB.rules:
+            self.assertEqual(KB.store.count(fact_rule), len(KB.kb_explain(fact_rule)))
+
+    def test4(self):
+        # the premises of a removed fact stop listing it as a dependent
+        for count_only in [True, False]:
+            KB = KnowledgeBase([], [], count_only=count_only)
+            KB.kb_assert(read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)"))
+            for _ in range(200):
+                KB.kb_assert(read.parse_input("fact: (motherof zed yan)"))
+                KB.kb_retract(read.parse_input("fact: (motherof zed yan)"))
+            self.assertLess(len(KB.store.dependents.get(KB.rules[0].ident, ())), 100)
+
+
+class EvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest, but no derived fact is kept materialized
+        self.KB = load_kb(budget=0)
+
+    def test1(self):
+        # derived facts are evicted and re-derived when asked about
+        self.assertTrue(all(fact.asserted for fact in self.KB.facts))
+        self.assertIn("parentof", self.KB.partial)
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        answer = self.KB.kb_ask(ask1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(str(answer[1]), "?X : chen")
+        self.assertEqual(len(self.KB.usage), 0)
+
+    def test2(self):
+        # asserted facts are never evicted and retraction still works
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        answer = self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.assertEqual(len(answer), 1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+
+
+class OverlayTest(unittest.TestCase):
+
+    def setUp(self):
+        # one shared base KB with an overlay per tenant
+        self.KB = load_kb()
+        self.tenant1 = KnowledgeBaseOverlay(self.KB)
+        self.tenant2 = KnowledgeBaseOverlay(self.KB)
+
+    def test1(self):
+        # inference in an overlay only stores the deltas
+        count = len(self.KB.facts)
+        self.tenant1.kb_assert(read.parse_input("fact: (sisters bing ida)"))
+        answer = self.tenant1.kb_ask(read.parse_input("fact: (auntof ida ?X)"))
+        self.assertEqual(str(answer[0]), "?X : chen")
+        self.assertEqual(len(self.tenant1.facts), 2)
+        self.assertEqual(len(self.KB.facts), count)
+        self.assertFalse(self.tenant2.kb_ask(read.parse_input("fact: (auntof ida ?X)")))
+
+    def test2(self):
+        # retraction is scoped to the overlay
+        self.tenant1.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        answer = self.tenant1.kb_ask(ask1)
+        self.assertEqual(len(answer), 1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(len(self.tenant2.kb_ask(ask1)), 2)
+        self.assertEqual(len(self.KB.kb_ask(ask1)), 2)
+
+    def test3(self):
+        # facts supporting each other through a cycle don't survive their source
+        base = KnowledgeBase([], [])
+        for text in ["rule: ((edge ?x ?y)) -> (path ?x ?y)",
+                     "rule: ((path ?x ?y) (path ?y ?z)) -> (path ?x ?z)",
+                     "fact: (edge a b)", "fact: (edge b a)", "fact: (edge b c)"]:
+            base.kb_assert(read.parse_input(text))
+        count = len(base.facts)
+        tenant = KnowledgeBaseOverlay(base)
+        tenant.kb_retract(read.parse_input("fact: (edge b a)"))
+        answer = tenant.kb_ask(read.parse_input("fact: (path ?X ?Y)"))
+        self.assertEqual(sorted(str(b) for b in answer),
+                         ["?X : a, ?Y : b", "?X : a, ?Y : c", "?X : b, ?Y : c"])
+        self.assertEqual(len(base.facts), count)
+        self.assertEqual(len(base.kb_ask(read.parse_input("fact: (path ?X ?Y)"))), 6)
+
+    def test4(self):
+        # retracting a base rule in an overlay removes what was derived through it
+        rule = read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)")
+        self.tenant1.kb_retract(rule)
+        ask1 = read.parse_input("fact: (parentof ada ?X)")
+        self.assertEqual(self.tenant1.kb_ask(ask1), [])
+        self.assertEqual(str(self.tenant2.kb_ask(ask1)[0]), "?X : bing")
+        self.assertIsNotNone(self.KB._get_rule(rule))
+        self.tenant1.kb_assert(read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)"))
+        self.assertEqual(str(self.tenant1.kb_ask(ask1)[0]), "?X : bing")
+
+    def test5(self):
+        # removing a base fact hides it and what was derived only through it,
+        # the same way retracting does
+        self.tenant1.kb_remove(self.KB._get_fact(read.parse_input("fact: (motherof ada bing)")))
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        self.assertEqual([str(b) for b in self.tenant1.kb_ask(ask1)], ["?X : felix"])
+        self.assertEqual(len(self.KB.kb_ask(ask1)), 2)
+        # a derived fact with another derivation is derived again
+        fact = self.KB._get_fact(read.parse_input("fact: (parentof ada bing)"))
+        tenant = KnowledgeBaseOverlay(self.KB)
+        tenant.kb_assert(read.parse_input("fact: (fatherof ada bing)"))
+        tenant.kb_assert(read.parse_input("rule: ((fatherof ?x ?y)) -> (parentof ?x ?y)"))
+        tenant.kb_remove(fact)
+        self.assertTrue(tenant.kb_ask(read.parse_input("fact: (parentof ada bing)")))
+        self.assertTrue(self.KB._holds(fact))
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest, keeping every version
+        self.KB = load_kb(versioned=True)
+
+    def test1(self):
+        # past versions can be asked about after a retraction
+        version = self.KB.kb_version()
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        self.assertEqual(len(self.KB.kb_ask(ask1)), 1)
+        answer = self.KB.kb_ask(ask1, as_of=version)
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(str(answer[1]), "?X : chen")
+        self.assertFalse(self.KB.kb_ask(ask1, as_of=0))
+
+    def test2(self):
+        # collected versions can no longer be asked about
+        version = self.KB.kb_version()
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        self.KB.history.collect(self.KB.kb_version())
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        self.assertFalse(self.KB.kb_ask(ask1, as_of=version))
+        self.assertEqual(len(self.KB.kb_ask(ask1, as_of=self.KB.kb_version())), 1)
+
+
+class ChangeStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest
+        self.KB = load_kb()
+
+    def test1(self):
+        # derived facts that disappear are delivered to matching subscriptions
+        sub = self.KB.kb_subscribe(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        changes = sub.poll()
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0].op, 'remove')
+        self.assertEqual(str(changes[0].bindings), "?X : chen")
+        self.assertFalse(sub.poll())
+
+    def test2(self):
+        # a subscription can resume from the offset it committed
+        pattern = read.parse_input("fact: (grandmotherof ?X ?Y)")
+        sub = self.KB.kb_subscribe(pattern)
+        self.KB.kb_assert(read.parse_input("fact: (motherof eva ada)"))
+        first = sub.poll()
+        sub.commit()
+        self.KB.kb_retract(read.parse_input("fact: (motherof eva ada)"))
+        # the consumer restarts, the abandoned subscription still holds the log
+        resumed = self.KB.kb_subscribe(pattern, offset=sub.committed)
+        sub.close()
+        self.assertEqual([str(c.bindings) for c in first], ["?X : eva, ?Y : bing"])
+        self.assertEqual([c.op for c in resumed.poll()], ['remove'])
+
+
+class ShardedTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest, with facts spread over two shard processes
+        self.KB = load_kb(kb=ShardedKnowledgeBase(2, 'argument'))
+
+    def tearDown(self):
+        self.KB.close()
+
+    def test1(self):
+        # rules joining facts stored on different shards
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        answer = self.KB.kb_ask(ask1)
+        self.assertEqual(sorted(str(b) for b in answer), ["?X : chen", "?X : felix"])
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        answer = self.KB.kb_ask(ask1)
+        self.assertEqual([str(b) for b in answer], ["?X : felix"])
+
+    def test2(self):
+        # a fact with a variable first argument is found from every shard
+        # and joins with rules both ways
+        self.KB.kb_assert(read.parse_input("fact: (person bob)"))
+        self.KB.kb_assert(read.parse_input("fact: (likes ?anyone pizza)"))
+        self.KB.kb_assert(read.parse_input("rule: ((person ?p) (likes ?p ?f)) -> (eats ?p ?f)"))
+        answer = self.KB.kb_ask(read.parse_input("fact: (likes bob ?X)"))
+        self.assertEqual([str(b) for b in answer], ["?ANYONE : bob, ?X : pizza"])
+        answer = self.KB.kb_ask(read.parse_input("fact: (eats ?X ?Y)"))
+        self.assertEqual([str(b) for b in answer], ["?X : bob, ?Y : pizza"])
+
+    def test3(self):
+        with self.assertRaises(ValueError):
+            ShardedKnowledgeBase(2, 'subject')
+
+
+class StartupTest(unittest.TestCase):
+
+    def test1(self):
+        # KBs built with the defaults don't share their facts and rules
+        kb1 = KnowledgeBase()
+        kb1.kb_assert(read.parse_input("fact: (motherof ada bing)"))
+        kb2 = KnowledgeBase()
+        self.assertEqual(kb2.facts, [])
+        self.assertFalse(kb2.kb_ask(read.parse_input("fact: (motherof ada ?X)")))
+
+    def test2(self):
+        # cold start: optional modules aren't imported
+        code = ("import sys; import student_code; student_code.KnowledgeBase(); "
+                "optional = ('read', 'copy', 'history', 'changes', 'json', 'sqlite3', 'tempfile'); "
+                "print(' '.join(m for m in optional if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(
+            os.path.abspath(__file__))).decode().strip()
+        self.assertEqual(output, '')
+
+
+class CLITest(unittest.TestCase):
+
+    def test1(self):
+        # queries run in worker processes, answers written as JSONL in order
+        directory = tempfile.mkdtemp()
+        queries = os.path.join(directory, 'queries.txt')
+        output = os.path.join(directory, 'answers.jsonl')
+        with open(queries, 'w') as file:
+            file.write("fact: (grandmotherof ada ?X)\nfact: (motherof ?X felix)\nfact: (motherof felix ?X)\n")
+        with open(os.devnull, 'w') as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                status = cli.main(['statements_kb4.txt', '--queries', queries, '--workers', '2',
+                                   '--output', output])
+            finally:
+                sys.stderr = stderr
+        self.assertEqual(status, 0)
+        with open(output) as file:
+            results = [json.loads(line) for line in file]
+        shutil.rmtree(directory)
+        self.assertEqual([r['query'] for r in results],
+                         ["(grandmotherof ada ?X)", "(motherof ?X felix)", "(motherof felix ?X)"])
+        self.assertEqual(results[0]['answers'], [{"?X": "felix"}, {"?X": "chen"}])
+        self.assertEqual(results[1]['answers'], [{"?X": "greta"}])
+        self.assertEqual(results[2]['answers'], [])
+
+    def test2(self):
+        # a snapshot loaded in a new process can be asserted to and retracted from
+        statements = ["rule: ((edge ?x ?y)) -> (path ?x ?y)",
+                      "rule: ((path ?x ?y) (path ?y ?z)) -> (path ?x ?z)",
+                      "fact: (edge a b)", "fact: (edge b c)"]
+        changes = [('assert', "fact: (edge c d)"), ('retract', "fact: (edge a b)"),
+                   ('assert', "fact: (edge d e)"), ('retract', "fact: (edge b c)"),
+                   ('retract', "rule: ((path ?x ?y) (path ?y ?z)) -> (path ?x ?z)"),
+                   ('assert', "rule: ((path ?x ?y) (path ?y ?z)) -> (path ?x ?z)"),
+                   ('assert', "fact: (edge e a)"), ('retract', "fact: (edge c d)")]
+        directory = tempfile.mkdtemp()
+        snapshot = os.path.join(directory, 'kb.pickle')
+        # saved and loaded by new processes, numbering facts and rules from 0
+        save = ("import sys, json, read, cli\n"
+                "KB = cli.saturate([read.parse_input(text) for text in json.loads(sys.argv[2])])\n"
+                "cli.save_snapshot(KB, sys.argv[1])\n")
+        load = ("import sys, json, read, cli\n"
+                "KB = cli.load_snapshot(sys.argv[1])\n"
+                "for op, text in json.loads(sys.argv[2]):\n"
+                "    getattr(KB, 'kb_' + op)(read.parse_input(text))\n"
+                "    sys.stderr.write(json.dumps(sorted(f.key() for f in KB.facts)) + '\\n')\n")
+        outputs = []
+        with open(os.devnull, 'w') as devnull:
+            for script, argument in [(save, statements), (load, changes)]:
+                outputs.append(subprocess.run(
+                    [sys.executable, '-c', script, snapshot, json.dumps(argument)],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stdout=devnull, stderr=subprocess.PIPE, check=True).stderr)
+        shutil.rmtree(directory)
+        KB = cli.saturate([read.parse_input(text) for text in statements])
+        lines = outputs[1].decode().splitlines()
+        self.assertEqual(len(lines), len(changes))
+        for (op, text), line in zip(changes, lines):
+            getattr(KB, 'kb_' + op)(read.parse_input(text))
+            self.assertEqual(json.loads(line), [list(key) for key in sorted(f.key() for f in KB.facts)])
+
+
+class MagicTest(unittest.TestCase):
+
+    def test1(self):
+        # only the facts relevant to the expected query are derived
+        data = read.read_tokenize('statements_kb4.txt')
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        KB = KnowledgeBase()
+        for item in magic_rewrite(data, [ask1]):
+            KB.kb_assert(item)
+        answer = KB.kb_ask(ask1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(str(answer[1]), "?X : chen")
+        derived = sorted(str(fact.statement) for fact in KB.facts if not fact.asserted)
+        self.assertEqual(derived, ["(grandmotherof ada chen)", "(magic_parentof_bf bing)",
+                                   "(parentof bing chen)"])
+
+
+class AgendaTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest, inferring only when asked to run
+        self.KB = load_kb(agenda=True)
+
+    def test1(self):
+        # inference advances in bounded steps until the KB is saturated
+        ask1 = read.parse_input("fact: (grandmotherof ada ?X)")
+        self.assertFalse(self.KB.kb_saturated())
+        self.assertEqual(len(self.KB.kb_ask(ask1)), 1)
+        self.assertEqual(self.KB.kb_run(max_steps=2), 2)
+        self.KB.kb_run(deadline=time.time() + 60)
+        self.assertTrue(self.KB.kb_saturated())
+        answer = self.KB.kb_ask(ask1)
+        self.assertEqual(str(answer[0]), "?X : felix")
+        self.assertEqual(str(answer[1]), "?X : chen")
+
+    def test2(self):
+        # activations of rules with a higher priority run first
+        KB = KnowledgeBase(agenda=True)
+        KB.kb_assert(read.parse_input("fact: (motherof ada bing)"))
+        KB.kb_assert(read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)"))
+        urgent = read.parse_input("rule: ((motherof ?x ?y)) -> (childof ?y ?x)")
+        urgent.priority = 1
+        KB.kb_assert(urgent)
+        KB.kb_run(max_steps=1)
+        self.assertTrue(KB.kb_ask(read.parse_input("fact: (childof bing ada)")))
+        self.assertFalse(KB.kb_ask(read.parse_input("fact: (parentof ada bing)")))
+
+    def test3(self):
+        # transitive closures join on the agenda too, one fact per activation,
+        # so a long chain is neither inferred on assert nor recursed through
+        KB = KnowledgeBase(agenda=True)
+        KB.kb_assert(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        for i in range(300):
+            KB.kb_assert(read.parse_input("fact: (isa c{} c{})".format(i, i + 1)))
+        KB.kb_assert(read.parse_input("fact: (inst a c0)"))
+        self.assertEqual(len(KB.facts), 301)
+        self.assertFalse(KB.kb_saturated())
+        KB.kb_run()
+        self.assertTrue(KB.kb_saturated())
+        self.assertTrue(KB.kb_ask(read.parse_input("fact: (inst a c300)")))
+
+
+class MemoryReportTest(unittest.TestCase):
+
+    def test1(self):
+        # memory per class, predicate and asserted rule, and allocations per function
+        data = read.read_tokenize('statements_kb4.txt')
+        KB = KnowledgeBase()
+        report = KB.kb_memory_report(trace=lambda: [KB.kb_assert(item) for item in data])
+        self.assertEqual(report.classes['Fact'][0], len(KB.facts))
+        self.assertEqual(report.classes['Rule'][0], len(KB.rules))
+        self.assertEqual(report.predicates['motherof'][0], 4)
+        self.assertEqual(len(report.rules), 3)
+        self.assertEqual(report.fanout['supports'][0], 4)
+        self.assertGreater(report.allocations['fc_infer'][1], 0)
+        self.assertGreater(report.allocations['instantiate'][1], 0)
+        self.assertGreater(report.total, 0)
+
+    def test2(self):
+        # dependents whose justifications were retracted don't count as fanout
+        KB = load_kb()
+        for i in range(30):
+            fact = read.parse_input("fact: (motherof zed y{})".format(i))
+            KB.kb_assert(fact)
+            KB.kb_retract(fact)
+        report = KB.kb_memory_report()
+        self.assertEqual(report.fanout['supports'][0], 4)
+
+
+class BatchAskTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest
+        self.KB = load_kb()
+
+    def test1(self):
+        # answers per query, in order, the same as asking one by one
+        asks = [read.parse_input("fact: (motherof {} ?Y)".format(name))
+                for name in ['ada', 'bing', 'nobody', 'dolores']]
+        asks.append(read.parse_input("fact: (grandmotherof ada ?X)"))
+        asks.append(read.parse_input("fact: (sisters ?X ?X)"))
+        answers = self.KB.kb_ask_batch(asks)
+        self.assertEqual(len(answers), len(asks))
+        for ask, answer in zip(asks, answers):
+            expected = self.KB.kb_ask(ask)
+            self.assertEqual([str(b) for b in answer], [str(b) for b in expected])
+        self.assertEqual(str(answers[0][0]), "?Y : bing")
+        self.assertFalse(answers[2])
+        self.assertEqual(len(answers[4]), 2)
+
+    def test2(self):
+        # facts with a variable in a bound position answer every query of the shape
+        for backend in [None, SqliteFactStore()]:
+            KB = KnowledgeBase([], [], backend=backend)
+            KB.kb_assert(read.parse_input("fact: (likes ?anyone pizza)"))
+            KB.kb_assert(read.parse_input("fact: (likes bob tea)"))
+            asks = [read.parse_input("fact: (likes bob ?X)"), read.parse_input("fact: (likes amy ?X)")]
+            answers = KB.kb_ask_batch(asks)
+            for ask, answer in zip(asks, answers):
+                self.assertEqual([str(b) for b in answer], [str(b) for b in KB.kb_ask(ask)])
+            self.assertEqual([len(answer) for answer in answers], [2, 1])
+            KB.backend.close()
+
+
+class StatementTest(unittest.TestCase):
+
+    def test1(self):
+        # equal statements are one shared instance, however they are built
+        fact = read.parse_input("fact: (motherof ada bing)")
+        rule = read.parse_input("rule: ((motherof ?x ?y)) -> (parentof ?x ?y)")
+        bindings = match(rule.lhs[0], fact.statement)
+        self.assertIs(Statement(['motherof', 'ada', 'bing']), fact.statement)
+        self.assertIs(instantiate(rule.rhs, bindings), Statement(['parentof', 'ada', 'bing']))
+        self.assertIs(pickle.loads(pickle.dumps(fact)).statement, fact.statement)
+        self.assertEqual(hash(fact.statement), hash(fact.statement.key()))
+
+    def test2(self):
+        # statements of different arity are not equal
+        self.assertNotEqual(Statement(['motherof', 'ada']), Statement(['motherof', 'ada', 'bing']))
+
+
+class HarnessTest(unittest.TestCase):
+
+    def test1(self):
+        # configurations agree with the reference engine without recursive rules
+        report = harness.run(range(20), rules=harness.RULES[:3])
+        self.assertEqual(report.divergences, [])
+        summary = report.summary()
+        self.assertEqual(sorted(summary), sorted(harness.ENGINES))
+        self.assertGreater(summary['default']['assert'][2], 0)
+        slow = dict((engine, dict((op, [1e9, 1e9, 1]) for op in ops))
+                    for engine, ops in summary.items())
+        self.assertEqual(report.regressions(slow, 1.5), [])
+        fast = dict((engine, dict((op, [1e-9, 1e-9, 1]) for op in ops))
+                    for engine, ops in summary.items())
+        self.assertTrue(report.regressions(fast, 1.5))
+
+    def test2(self):
+        # an engine that ignores retractions is caught
+        class Forgetful(KnowledgeBase):
+            def kb_retract(self, fact_or_rule):
+                pass
+        harness.register('forgetful', Forgetful)
+        try:
+            report = harness.run(range(5), engines=['forgetful'])
+        finally:
+            del harness.ENGINES['forgetful']
+        self.assertTrue(report.divergences)
+        self.assertTrue(all('on forgetful' in d for d in report.divergences))
+
+    def test3(self):
+        # the reference engine matches variables in facts too, and traces
+        # assert facts with variables
+        reference = harness.ReferenceKB()
+        reference.kb_assert(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (kind ?x ?z)"))
+        reference.kb_assert(read.parse_input("fact: (inst a b)"))
+        reference.kb_assert(read.parse_input("fact: (isa ?q c)"))
+        self.assertEqual(reference.kb_ask(read.parse_input("fact: (kind a ?Z)")), [{'?Z': 'c'}])
+        asserted = [item for seed in range(10) for op, item in harness.trace(seed)
+                    if op == 'assert' and isinstance(item, Fact)]
+        self.assertTrue(any(term[0] == '?' for item in asserted for term in item.key()[1:]))
+
+    def test4(self):
+        # the cold start is gated against the budget
+        self.assertGreater(harness.startup_time(runs=1), 0)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(harness.main(['--seeds', '0', '--startup-budget', '1e-9']), 1)
+        self.assertIn("REGRESSION startup", output.getvalue())
+
+
+class RetractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for text in ["rule: ((edge ?x ?y)) -> (path ?x ?y)",
+                     "rule: ((path ?x ?y) (path ?y ?z)) -> (path ?x ?z)",
+                     "fact: (edge a b)", "fact: (edge b a)", "fact: (edge b c)"]:
+            self.KB.kb_assert(read.parse_input(text))
+
+    def test1(self):
+        # facts supporting each other through a cycle don't survive their source
+        self.KB.kb_retract(read.parse_input("fact: (edge b a)"))
+        keys = sorted(f.key() for f in self.KB.facts)
+        self.assertEqual(keys, [('edge', 'a', 'b'), ('edge', 'b', 'c'), ('path', 'a', 'b'),
+                                ('path', 'a', 'c'), ('path', 'b', 'c')])
+        path = self.KB._get_fact(read.parse_input("fact: (path a c)"))
+        self.assertEqual(len(path.supported_by), 1)
+
+    def test2(self):
+        # conclusions with another derivation are kept, with the justifications left
+        self.KB.kb_assert(read.parse_input("fact: (edge a c)"))
+        self.KB.kb_retract(read.parse_input("fact: (edge b c)"))
+        path = self.KB._get_fact(read.parse_input("fact: (path a c)"))
+        self.assertIsNotNone(path)
+        supports = sorted([p.ident for p in pair] for pair in path.supported_by)
+        self.assertEqual(supports, sorted([p.ident for p in pair]
+                                          for pair in self.KB.kb_explain(path)))
+        self.assertIn(('edge', 'a', 'c'), [pair[0].key() for pair in path.supported_by])
+        # (path b c) still follows from (path b a) and (path a c)
+        keys = sorted(f.key()[1:] for f in self.KB.facts if f.key()[0] == 'path')
+        self.assertEqual(keys, [('a', 'a'), ('a', 'b'), ('a', 'c'),
+                                ('b', 'a'), ('b', 'b'), ('b', 'c')])
+
+    def test3(self):
+        # retracting a rule removes the rules and facts curried from it
+        rule = read.parse_input("rule: ((path ?x ?y) (path ?y ?z)) -> (path ?x ?z)")
+        self.KB.kb_retract(rule)
+        keys = sorted(f.key() for f in self.KB.facts if f.key()[0] == 'path')
+        self.assertEqual(keys, [('path', 'a', 'b'), ('path', 'b', 'a'), ('path', 'b', 'c')])
+        self.assertEqual([r for r in self.KB.rules if len(r.lhs) == 1 and
+                          r.rhs.predicate == 'path' and r.lhs[0].predicate == 'path'], [])
+
+    def test4(self):
+        # rederiving after a retraction only tries the rules and facts that
+        # could conclude what was deleted, however many other facts there are
+        tried = []
+        for n in (50, 200):
+            KB = KnowledgeBase()
+            KB.kb_assert(read.parse_input(
+                    "rule: ((motherof ?x ?y) (parentof ?y ?z)) -> (grandmotherof ?x ?z)"))
+            for i in range(n):
+                KB.kb_assert(read.parse_input("fact: (motherof m{0} c{0})".format(i)))
+                KB.kb_assert(read.parse_input("fact: (parentof c{0} g{0})".format(i)))
+            infer = KB.ie.infer
+            calls = []
+            KB.ie.infer = lambda fact, rule: calls.append(fact) or infer(fact, rule)
+            KB.kb_retract(read.parse_input("fact: (parentof c0 g0)"))
+            KB.kb_retract(read.parse_input("fact: (motherof m1 c1)"))
+            self.assertEqual(len(KB.facts), 3 * n - 4)
+            tried.append(len(calls))
+        self.assertEqual(tried[0], tried[1])
+
+class SqliteStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        # same KB as KBTest, with facts on disk and only a few kept in memory
+        self.backend = SqliteFactStore(cache_size=2)
+        self.KB = load_kb(backend=self.backend)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def test1(self):
+        # same answers as the KB in memory
+        memory = load_kb()
+        for text in ["fact: (grandmotherof ada ?X)", "fact: (parentof ?X ?Y)",
+                     "fact: (motherof ?X chen)", "fact: (auntof ?X ?Y)"]:
+            ask = read.parse_input(text)
+            self.assertEqual([str(b) for b in self.KB.kb_ask(ask)],
+                             [str(b) for b in memory.kb_ask(ask)])
+        self.assertEqual([f.key() for f in self.KB.facts], [f.key() for f in memory.facts])
+
+    def test2(self):
+        # facts dropped from memory are rebuilt with their ID and asserted flag
+        fact = self.KB._get_fact(read.parse_input("fact: (grandmotherof ada chen)"))
+        ident = fact.ident
+        del fact
+        self.KB.kb_ask(read.parse_input("fact: (motherof ?X ?Y)"))
+        fact = self.KB._get_fact(read.parse_input("fact: (grandmotherof ada chen)"))
+        self.assertEqual(fact.ident, ident)
+        self.assertFalse(fact.asserted)
+        self.assertEqual(str(fact.supported_by[0][0].statement), "(motherof ada bing)")
+        self.assertLessEqual(len(self.backend.cache), 2)
+
+    def test3(self):
+        # retracting removes the rows of the facts derived from it
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        answer = self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada ?X)"))
+        self.assertEqual([str(b) for b in answer], ["?X : felix"])
+        self.assertEqual(len(self.backend), len(self.KB.facts))
+        path = self.backend.path
+        self.backend.close()
+        self.assertFalse(os.path.exists(path))
 
 
 
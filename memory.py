@@ -0,0 +1,272 @@
+import sys
+from logical_classes import *
+
+class MemoryReport(object):
+    """Breakdown of the memory used by the structures of a KnowledgeBase, as
+        measured by sys.getsizeof. Strings shared between objects are counted
+        once, with the first object they were found in.
+
+    Attributes:
+        classes (dictof str: [int, int]): [count, bytes] per class, e.g. 'Fact',
+            'Statement', 'Term'; the bytes of an instance include its __dict__
+            and the lists it owns, such as the terms of a Statement
+        predicates (dictof str: [int, int]): [facts, bytes] per predicate
+        rules (dictof str: [int, int, int]): [curried rules, facts, bytes]
+            derived from each asserted rule, including the rule itself
+        structures (dictof str: int): bytes of the tables and indexes of the KB,
+            e.g. 'supported_by' for the justifications and 'supports' for the
+            lists of dependents
+        fanout (dictof str: tuple): ('max', 'mean', heaviest fact or rule) of
+            the dependents ('supports') and justifications ('supported_by') of
+            the facts and rules of the KB
+        allocations (dictof str: [int, int]|None): [blocks, bytes] allocated by
+            'fc_infer', 'instantiate', 'match' and 'other' code while tracing
+        total (int): bytes of the classes and structures together
+    """
+    def __init__(self):
+        """Constructor for MemoryReport with empty sections
+        """
+        super(MemoryReport, self).__init__()
+        self.classes = {}
+        self.predicates = {}
+        self.rules = {}
+        self.structures = {}
+        self.fanout = {}
+        self.allocations = None
+        self.total = 0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'MemoryReport({!r} bytes)'.format(self.total)
+
+    def __str__(self):
+        """Define external representation when printed
+        """
+        lines = ["Memory: {} bytes".format(self.total), "Per class:"]
+        for name, (count, size) in sorted(self.classes.items(), key=lambda i: -i[1][1]):
+            lines.append("\t{:<12} {:>8} objects {:>10} bytes".format(name, count, size))
+        lines.append("Per structure:")
+        for name, size in sorted(self.structures.items(), key=lambda i: -i[1]):
+            lines.append("\t{:<12} {:>10} bytes".format(name, size))
+        lines.append("Per predicate:")
+        for name, (count, size) in sorted(self.predicates.items(), key=lambda i: -i[1][1]):
+            lines.append("\t{:<20} {:>8} facts {:>10} bytes".format(name, count, size))
+        lines.append("Per asserted rule:")
+        for name, (rules, facts, size) in sorted(self.rules.items(), key=lambda i: -i[1][2]):
+            lines.append("\t{} {} rules {} facts {} bytes".format(name, rules, facts, size))
+        lines.append("Fan-out:")
+        for name, (most, mean, heaviest) in sorted(self.fanout.items()):
+            lines.append("\t{:<12} max {} mean {:.2f} ({})".format(name, most, mean, heaviest))
+        if self.allocations is not None:
+            lines.append("Allocations while tracing:")
+            for name, (count, size) in sorted(self.allocations.items(), key=lambda i: -i[1][1]):
+                lines.append("\t{:<12} {:>8} blocks {:>10} bytes".format(name, count, size))
+        return "\n".join(lines)
+
+class _Walker(object):
+    """INTERNAL USE ONLY
+    Measures objects once each, adding their bytes to the classes of a report
+    """
+    def __init__(self, report):
+        self.report = report
+        self.seen = set()
+
+    def size(self, obj):
+        """Bytes of obj not counted before, the containers it holds included
+            but not the facts, rules, statements and terms they refer to
+        """
+        if id(obj) in self.seen:
+            return 0
+        self.seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                size += self.size(key) + self.size(value)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            for item in obj:
+                size += self.size(item)
+        return size
+
+    def add(self, name, size):
+        entry = self.report.classes.setdefault(name, [0, 0])
+        entry[0] += 1
+        entry[1] += size
+
+    def instance(self, obj, owned=()):
+        """Bytes of an instance, its __dict__ and the containers it owns
+        """
+        if id(obj) in self.seen:
+            return 0
+        self.seen.add(id(obj))
+        size = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+        for container in owned:
+            size += self.size(container)
+        self.add(type(obj).__name__, size)
+        return size
+
+    def term(self, term):
+        size = self.instance(term)
+        element = term.term
+        return size + self.instance(element, [element.element])
+
+    def statement(self, statement):
+        size = self.instance(statement, [statement.terms, statement.predicate])
+        return size + sum(self.term(term) for term in statement.terms)
+
+    def fact_rule(self, fact_rule):
+        if isinstance(fact_rule, Fact):
+            size = self.instance(fact_rule, [fact_rule._supported_by, fact_rule.name])
+            return size + self.statement(fact_rule.statement)
+        size = self.instance(fact_rule, [fact_rule.lhs, fact_rule._supported_by, fact_rule.name])
+        return size + sum(self.statement(s) for s in fact_rule.lhs + [fact_rule.rhs])
+
+def _fanout(objects, sizes):
+    """INTERNAL USE ONLY
+    (max, mean, heaviest) of the given sizes per fact/rule
+    """
+    if not objects:
+        return (0, 0.0, None)
+    heaviest = max(range(len(objects)), key=lambda i: sizes[i])
+    return (sizes[heaviest], float(sum(sizes)) / len(objects),
+            str(objects[heaviest].key()))
+
+def memory_report(kb, trace=None):
+    """Measure the memory used by a KnowledgeBase
+
+    Args:
+        kb (KnowledgeBase): KB to measure
+        trace (callable|None): work to run under tracemalloc, e.g. asserting a
+            batch of facts, to attribute the allocations it makes to fc_infer,
+            instantiate and match
+
+    Returns:
+        MemoryReport
+    """
+    report = MemoryReport()
+    if trace is not None:
+        report.allocations = trace_allocations(trace)
+    walker = _Walker(report)
+
+    sizes = {}
+    for fact in kb.facts:
+        size = walker.fact_rule(fact)
+        sizes[fact.ident] = size
+        entry = report.predicates.setdefault(fact.statement.predicate, [0, 0])
+        entry[0] += 1
+        entry[1] += size
+    for rule in kb.rules:
+        sizes[rule.ident] = walker.fact_rule(rule)
+
+    store = kb.store
+    report.structures['supported_by'] = walker.size(store.justifications) + walker.size(store.counts)
+    report.structures['supports'] = walker.size(store.dependents)
+    report.structures['store'] = walker.size(store.objects)
+    report.structures['tables'] = walker.size(kb.rule_table)
+    report.structures['indexes'] = walker.size(kb.rule_index) + walker.size(kb.producer_index)
+    for name, container in kb.backend.structures().items():
+        report.structures[name] = report.structures.get(name, 0) + walker.size(container)
+    closures = walker.size(kb.closure_index)
+    for closure in kb.closures.values():
+        closures += (walker.size(closure.left) + walker.size(closure.right) +
+                     walker.size(closure.sources))
+    report.structures['closures'] = closures
+    report.structures['usage'] = walker.size(kb.usage) + walker.size(kb.partial)
+    if kb.history:
+        report.structures['history'] = (walker.size(kb.history.records) +
+                                        walker.size(kb.history.current))
+
+    # everything derived through the curried rules of each asserted rule
+    for rule in kb.rules:
+        if not rule.asserted:
+            continue
+        rules, facts, size = 1, 0, sizes.get(rule.ident, 0)
+        pending = [rule]
+        visited = set([rule.ident])
+        while pending:
+            for dependent in store.supports(pending.pop()):
+                if dependent.ident in visited:
+                    continue
+                visited.add(dependent.ident)
+                size += sizes.get(dependent.ident, 0)
+                if isinstance(dependent, Rule):
+                    rules += 1
+                    pending.append(dependent)
+                else:
+                    facts += 1
+        report.rules[str(rule.key())] = [rules, facts, size]
+
+    objects = kb.facts + kb.rules
+    report.fanout['supports'] = _fanout(objects,
+            [len(store.supports(fr)) for fr in objects])
+    report.fanout['supported_by'] = _fanout(objects,
+            [store.count(fr) for fr in objects])
+
+    report.total = (sum(size for count, size in report.classes.values()) +
+                    sum(report.structures.values()))
+    return report
+
+# functions allocations are attributed to, with the functions they are
+# implemented with
+TRACED = {
+    'fc_infer': ('student_code', 'InferenceEngine.fc_infer', 'InferenceEngine.infer'),
+    'instantiate': ('util', 'instantiate'),
+    'match': ('util', 'match', 'match_recursive'),
+}
+
+def _line_ranges():
+    """INTERNAL USE ONLY
+    (filename, first line, last line, name) of the source of the traced functions
+    """
+    import importlib, inspect
+    ranges = []
+    for name, spec in TRACED.items():
+        module = importlib.import_module(spec[0])
+        for path in spec[1:]:
+            function = module
+            for attribute in path.split('.'):
+                function = getattr(function, attribute)
+            lines, first = inspect.getsourcelines(function)
+            filename = inspect.getsourcefile(function)
+            ranges.append((filename, first, first + len(lines) - 1, name))
+    return ranges
+
+def trace_allocations(work):
+    """Run work under tracemalloc and attribute the memory it allocates to the
+        innermost traced function on the stack of each allocation
+
+    Args:
+        work (callable): code to trace
+
+    Returns:
+        dictof str: [int, int] - [blocks, bytes] still allocated after work, per
+            traced function, 'other' for allocations made outside them
+    """
+    import os, tracemalloc
+    ranges = [(os.path.abspath(f), a, b, name) for f, a, b, name in _line_ranges()]
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(32)
+    try:
+        before = tracemalloc.take_snapshot()
+        work()
+        after = tracemalloc.take_snapshot()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    allocations = dict((name, [0, 0]) for name in list(TRACED) + ['other'])
+    for stat in after.compare_to(before, 'traceback'):
+        if stat.size_diff <= 0:
+            continue
+        owner = 'other'
+        # innermost frame last
+        for frame in reversed(stat.traceback):
+            filename = os.path.abspath(frame.filename)
+            found = [name for f, a, b, name in ranges if f == filename and a <= frame.lineno <= b]
+            if found:
+                owner = found[0]
+                break
+        allocations[owner][0] += stat.count_diff
+        allocations[owner][1] += stat.size_diff
+    return allocations
@@ -0,0 +1,160 @@
+from logical_classes import *
+from student_code import KnowledgeBase, TransitiveClosure
+
+class KnowledgeBaseOverlay(KnowledgeBase):
+    """Copy-on-write view of a base KnowledgeBase. The facts, rules, indexes and
+        derived closure of the base are shared; the overlay only stores its own
+        deltas: the facts and rules asserted or inferred in it, extra
+        justifications involving them, and the base facts and rules retracted
+        from its point of view. Inference and retraction never modify the base.
+
+        The base should not be changed while overlays on it are in use.
+
+    Attributes:
+        base (KnowledgeBase): the shared knowledge base
+        hidden (setof int): IDs of base facts/rules removed in this overlay
+        assertions (dictof int: bool): asserted flags of base facts/rules that
+            were asserted or retracted in this overlay, by ID
+        shadows (dictof int: TransitiveClosure): overlay closures joining the
+            facts of the overlay against the base closures, by ident of their rule
+    """
+    def __init__(self, base):
+        """Constructor for KnowledgeBaseOverlay with no deltas
+
+        Args:
+            base (KnowledgeBase): knowledge base to share
+        """
+        super(KnowledgeBaseOverlay, self).__init__([], [], base.store.count_only)
+        self.base = base
+        self.hidden = set()
+        self.assertions = {}
+        self.shadows = {}
+
+    def __repr__(self):
+        return 'KnowledgeBaseOverlay({!r}, {!r}, {!r})'.format(self.base, self.facts, self.rules)
+
+    def _owns(self, fact_rule):
+        """INTERNAL USE ONLY
+        Check whether a fact or rule is one of the deltas of this overlay
+        """
+        return super(KnowledgeBaseOverlay, self)._holds(fact_rule)
+
+    def _holds(self, fact_rule):
+        return (self._owns(fact_rule) or
+                (fact_rule.ident not in self.hidden and self.base._holds(fact_rule)))
+
+    def _asserted(self, fact_rule):
+        """INTERNAL USE ONLY
+        Whether a fact or rule counts as asserted from the point of view of the overlay
+        """
+        if self._owns(fact_rule):
+            return fact_rule.asserted
+        return self.assertions.get(fact_rule.ident, fact_rule.asserted)
+
+    def _set_asserted(self, fact_rule):
+        if self._owns(fact_rule):
+            super(KnowledgeBaseOverlay, self)._set_asserted(fact_rule)
+        else:
+            self.assertions[fact_rule.ident] = True
+
+    def _get_fact(self, fact):
+        kbfact = self.backend.get(fact.key())
+        if kbfact is None:
+            kbfact = self.base._get_fact(fact)
+            if kbfact is not None and kbfact.ident in self.hidden:
+                kbfact = None
+        return kbfact
+
+    def _get_rule(self, rule):
+        kbrule = self.rule_table.get(rule.key())
+        if kbrule is None:
+            kbrule = self.base._get_rule(rule)
+            if kbrule is not None and kbrule.ident in self.hidden:
+                kbrule = None
+        return kbrule
+
+    def _canonical(self, lhs, rhs):
+        canonical = super(KnowledgeBaseOverlay, self)._canonical(lhs, rhs)
+        if canonical is None:
+            canonical = self.base._canonical(lhs, rhs)
+            if canonical is not None and canonical.ident in self.hidden:
+                canonical = None
+        return canonical
+
+    def _facts_for(self, statement):
+        facts = [f for f in self.base._facts_for(statement) if f.ident not in self.hidden]
+        return facts + super(KnowledgeBaseOverlay, self)._facts_for(statement)
+
+    def _rules_for(self, fact):
+        rules = [r for r in self.base._rules_for(fact) if r.ident not in self.hidden]
+        own = super(KnowledgeBaseOverlay, self)._rules_for(fact)
+        if rules and own:
+            return sorted(rules + own, key=lambda rule: rule.ident)
+        return rules or own
+
+    def _closures_for(self, predicate):
+        for closure in self.base._closures_for(predicate):
+            if closure.rule.ident not in self.shadows:
+                shadow = TransitiveClosure(closure.rule, closure)
+                self.shadows[closure.rule.ident] = shadow
+                for statement in closure.rule.lhs:
+                    closures = self.closure_index.setdefault(statement.predicate, [])
+                    if shadow not in closures:
+                        closures.append(shadow)
+        closures = super(KnowledgeBaseOverlay, self)._closures_for(predicate)
+        return [closure for closure in closures if self._holds(closure.rule)]
+
+    def _set_retracted(self, fact_rule):
+        if self._owns(fact_rule):
+            super(KnowledgeBaseOverlay, self)._set_retracted(fact_rule)
+        else:
+            self.assertions[fact_rule.ident] = False
+
+    def _supports(self, fact_rule):
+        dependents = self.store.supports(fact_rule)
+        if not self._owns(fact_rule):
+            dependents += [d for d in self.base._supports(fact_rule) if self._holds(d)]
+        return dependents
+
+    def _producers(self, predicate, argument=None):
+        rules = [r for r in self.base._producers(predicate, argument) if r.ident not in self.hidden]
+        own = super(KnowledgeBaseOverlay, self)._producers(predicate, argument)
+        if rules and own:
+            return sorted(rules + own, key=lambda rule: rule.ident)
+        return rules or own
+
+    def _delete(self, fr):
+        """INTERNAL USE ONLY
+        Take a fact or rule out of the overlay. Base facts and rules are hidden
+        rather than removed, so deleting and rederiving never modifies the base;
+        the ones rederived come back as deltas of the overlay.
+
+        Args:
+            fr (Fact|Rule) - visible fact or rule to take out
+        """
+        if self._owns(fr):
+            super(KnowledgeBaseOverlay, self)._delete(fr)
+        else:
+            if isinstance(fr, Fact):
+                # closures of the overlay's own rules index base facts too
+                self._unindex(fr)
+            self.hidden.add(fr.ident)
+            self.store.detach(fr)
+            self.store.unregister(fr)
+
+    def kb_remove(self, fr, evicting=False):
+        """Remove a fact or rule from the overlay, along with everything derived
+            from it that has no other derivation. Overlays have no budget, so
+            this goes through the same delete and rederive as kb_retract, base
+            facts and rules being hidden rather than removed.
+
+        Args:
+            fr (Fact|Rule) - the fact or rule to be removed
+            evicting (bool) - unused, overlays have no budget
+        """
+        if isinstance(fr, Rule) or isinstance(fr, Fact):
+            # _retract only starts from asserted facts and rules
+            self._set_asserted(fr)
+            self._retract(fr)
+        else:
+            print("Illegal data type in kb_remove")
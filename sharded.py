@@ -0,0 +1,297 @@
+import multiprocessing, zlib
+from logical_classes import *
+from util import is_var, match, match_keys, instantiate_key, printv
+from student_code import KnowledgeBase, verbose
+
+def _serve(conn):
+    """INTERNAL USE ONLY
+    Main loop of a shard worker process. The shard keeps its facts in a
+    KnowledgeBase without rules and answers requests from the coordinator until
+    told to stop:
+        ('add', keys) => keys of the facts that were new
+        ('ask', patterns) => per pattern, keys of the facts matching it
+        ('clear', None) => None
+        ('stop', None) => None
+
+    Args:
+        conn (Connection): worker end of the pipe to the coordinator
+    """
+    kb = KnowledgeBase([], [])
+    while True:
+        op, payload = conn.recv()
+        if op == 'add':
+            new = []
+            for key in payload:
+                fact = Fact(list(key))
+                if kb._get_fact(fact) is None:
+                    kb.kb_add(fact)
+                    new.append(key)
+            conn.send(new)
+        elif op == 'ask':
+            answers = []
+            for pattern in payload:
+                statement = Statement(list(pattern))
+                answers.append([fact.key() for fact in kb._facts_for(statement)
+                                if match(statement, fact.statement)])
+            conn.send(answers)
+        elif op == 'clear':
+            kb = KnowledgeBase([], [])
+            conn.send(None)
+        elif op == 'stop':
+            conn.send(None)
+            conn.close()
+            return
+
+class ShardedKnowledgeBase(object):
+    """Knowledge base whose facts are partitioned across local worker processes,
+        so it is not bounded by the memory and the core of a single process.
+        Facts are placed on a shard by a hash of their predicate, or of their
+        first argument; facts with a variable in its place are stored on every
+        shard, since they can match any value. The coordinator holds the rules
+        and saturates the shards in semi-naive rounds: every new fact is matched against each antecedent
+        of each rule and the other antecedents are joined by sending the
+        instantiated patterns to the shard owning them (or to every shard when
+        the partitioning term is still unbound), batched per shard and round.
+        Facts and rules are matched both ways, variables in facts included,
+        the rule being curried one antecedent at a time as forward chaining
+        does. Since a join starts from the new fact rather than from the first
+        antecedent, a fact whose variables share their names with the rule's
+        can bind differently than it does in KnowledgeBase.
+        kb_ask is only routed to the shards that can hold matching facts.
+
+        Retracting re-saturates the shards from the asserted facts.
+
+    Attributes:
+        partition (str): 'predicate' or 'argument', what facts are hashed on
+        rules (listof Rule): rules asserted
+        asserted (listof tuple): keys of the facts asserted, in order
+        conns (listof Connection): coordinator ends of the pipes to the shards
+        workers (listof Process): shard worker processes
+    """
+    def __init__(self, shards=2, partition='predicate'):
+        """Constructor for ShardedKnowledgeBase starting the shard processes
+
+        Args:
+            shards (int): number of worker processes
+            partition (str): 'predicate' or 'argument', what facts are hashed on
+
+        Raises:
+            ValueError: if partition is neither 'predicate' nor 'argument'
+        """
+        super(ShardedKnowledgeBase, self).__init__()
+        if partition not in ('predicate', 'argument'):
+            raise ValueError("Unknown partition: {!r}".format(partition))
+        self.partition = partition
+        self.rules = []
+        self.asserted = []
+        self.conns = []
+        self.workers = []
+        for i in range(shards):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_serve, args=(worker_conn,),
+                                             name="kb-shard-{}".format(i))
+            worker.daemon = True
+            worker.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def __repr__(self):
+        return 'ShardedKnowledgeBase({!r} shards, {!r}, {!r})'.format(
+                len(self.workers), self.partition, self.rules)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the shard processes
+        """
+        for conn in self.conns:
+            conn.send(('stop', None))
+        for conn, worker in zip(self.conns, self.workers):
+            conn.recv()
+            conn.close()
+            worker.join()
+        self.conns = []
+        self.workers = []
+
+    def _shards_for(self, pattern):
+        """INTERNAL USE ONLY
+        Indexes of the shards that can hold facts matching a pattern key
+        """
+        term = pattern[0:1] if self.partition == 'predicate' else pattern[1:2]
+        if not term or is_var(term[0]):
+            return range(len(self.conns))
+        return [zlib.crc32(term[0].encode()) % len(self.conns)]
+
+    def _request(self, op, per_shard):
+        """INTERNAL USE ONLY
+        Send one batch to each shard that has one, then collect the replies
+
+        Args:
+            op (str): 'add' or 'ask'
+            per_shard (dictof int: list): payload of each shard
+
+        Returns:
+            dictof int: list - reply of each shard
+        """
+        for shard, payload in per_shard.items():
+            self.conns[shard].send((op, payload))
+        return dict((shard, self.conns[shard].recv()) for shard in per_shard)
+
+    def _ask(self, patterns):
+        """INTERNAL USE ONLY
+        Keys of the facts matching each of the pattern keys
+
+        Returns:
+            dictof tuple: listof tuple
+        """
+        per_shard = {}
+        for pattern in patterns:
+            for shard in self._shards_for(pattern):
+                per_shard.setdefault(shard, []).append(pattern)
+        answers = dict((pattern, []) for pattern in patterns)
+        for shard, replies in self._request('ask', per_shard).items():
+            for pattern, keys in zip(per_shard[shard], replies):
+                answers[pattern].extend(keys)
+        # facts stored on every shard are found on each shard asked
+        return dict((pattern, list(dict.fromkeys(keys))) for pattern, keys in answers.items())
+
+    def _add(self, keys):
+        """INTERNAL USE ONLY
+        Store facts on their shards, or on every shard when the term they are
+        hashed on is a variable
+
+        Returns:
+            listof tuple: keys of the facts that were new
+        """
+        per_shard = {}
+        for key in keys:
+            for shard in self._shards_for(key):
+                per_shard.setdefault(shard, []).append(key)
+        new = []
+        for replies in self._request('add', per_shard).values():
+            new.extend(replies)
+        return list(dict.fromkeys(new))
+
+    def _join(self, rule, position, delta):
+        """INTERNAL USE ONLY
+        Conclusions of a rule whose antecedent at position matches one of the
+            delta facts, joining the other antecedents against the shards
+
+        Args:
+            rule (Rule): rule to evaluate
+            position (int): antecedent the delta facts are matched against
+            delta (listof tuple): keys of new facts
+
+        Returns:
+            listof tuple: keys of the facts inferred
+        """
+        rule = tuple(statement.key() for statement in rule.lhs + [rule.rhs])
+        # the rule curried with the facts matched so far
+        partials = [self._curry(rule, position, key) for key in delta]
+        partials = [partial for partial in partials if partial is not None]
+        for i in range(len(rule) - 1):
+            if i == position or not partials:
+                continue
+            answers = self._ask(set(partial[i] for partial in partials))
+            partials = [curried for partial in partials for key in answers[partial[i]]
+                        for curried in [self._curry(partial, i, key)] if curried is not None]
+        return [partial[-1] for partial in partials]
+
+    @staticmethod
+    def _curry(rule, position, key):
+        """INTERNAL USE ONLY
+        Match a fact against an antecedent of a rule and instantiate the rest of
+        the rule with the bindings, as fc_infer does
+
+        Args:
+            rule (tuple of tuple): keys of the LHS statements and of the RHS
+            position (int): antecedent the fact is matched against
+            key (tuple): key of the fact
+
+        Returns:
+            tuple of tuple|None: the rule instantiated, None if there is no match
+        """
+        bindings = match_keys(key, rule[position])
+        if bindings is None:
+            return None
+        return tuple(instantiate_key(statement, bindings) for statement in rule)
+
+    def _saturate(self, delta):
+        """INTERNAL USE ONLY
+        Infer everything that follows from new facts, in semi-naive rounds
+
+        Args:
+            delta (listof tuple): keys of facts just added to the shards
+        """
+        while delta:
+            inferred = []
+            for rule in self.rules:
+                for position, antecedent in enumerate(rule.lhs):
+                    matching = [key for key in delta if key[0] == antecedent.predicate]
+                    if matching:
+                        inferred.extend(self._join(rule, position, matching))
+            delta = self._add(inferred) if inferred else []
+
+    def kb_assert(self, fact_rule):
+        """Assert a fact or rule into the KB
+
+        Args:
+            fact_rule (Fact or Rule): Fact or Rule we're asserting
+        """
+        printv("Asserting {!r}", 0, verbose, [fact_rule])
+        if isinstance(fact_rule, Fact):
+            key = fact_rule.key()
+            if key not in self.asserted:
+                self.asserted.append(key)
+            self._saturate(self._add([key]))
+        elif isinstance(fact_rule, Rule):
+            if fact_rule in self.rules:
+                return
+            self.rules.append(fact_rule)
+            first = fact_rule.lhs[0].key()
+            self._saturate(self._add(self._join(fact_rule, 0, self._ask([first])[first])))
+        else:
+            print("Invalid assert:", fact_rule)
+
+    def kb_ask(self, fact):
+        """Ask if a fact is in the KB, only asking the shards that can hold it
+
+        Args:
+            fact (Fact) - Statement to be asked (will be converted into a Fact)
+
+        Returns:
+            listof Bindings|False - list of Bindings if result found, False otherwise
+        """
+        print("Asking {!r}".format(fact))
+        if not isinstance(fact, Fact):
+            print("Invalid ask:", fact.statement)
+            return []
+        pattern = fact.key()
+        bindings_lst = ListOfBindings()
+        for key in self._ask([pattern])[pattern]:
+            found = Fact(list(key))
+            bindings_lst.add_bindings(match(fact.statement, found.statement), [found])
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    def kb_retract(self, fact):
+        """Retract an asserted fact, re-saturating the shards from the
+            remaining asserted facts
+
+        Args:
+            fact (Fact) - Fact to be retracted
+        """
+        printv("Retracting {!r}", 0, verbose, [fact])
+        if not isinstance(fact, Fact):
+            print("Invalid retract:", fact)
+            return
+        key = fact.key()
+        if key not in self.asserted:
+            return
+        self.asserted.remove(key)
+        self._request('clear', dict((shard, None) for shard in range(len(self.conns))))
+        self._saturate(self._add(self.asserted))
@@ -0,0 +1,465 @@
+"""Storage backends holding the facts of a KnowledgeBase. MemoryFactStore keeps
+    them in Python dicts and is the default. SqliteFactStore keeps them in
+    indexed SQLite tables on disk, with a cache of the facts used most recently
+    in front of it, for KBs whose facts don't fit in memory, e.g.
+
+    kb = KnowledgeBase(backend=SqliteFactStore('facts.db', cache_size=100000))
+
+    A backend answers lookups by canonical form (get) and by pattern (facts_for),
+    always returning the same Fact object for a fact while anything refers to it.
+"""
+import os, weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from util import is_var
+from logical_classes import *
+
+def _first_argument(key):
+    """INTERNAL USE ONLY
+    First argument of a canonical form, None when it is a variable or missing
+    """
+    return key[1] if len(key) > 1 and not is_var(key[1]) else None
+
+class MemoryFactStore(object):
+    """Facts held in memory: by ID in the order they were added, in a table by
+        canonical form, in an index by predicate and in one by predicate and
+        first argument, like the rule index of the KB
+
+    Attributes:
+        order (dictof int: Fact): ID => fact, in the order they were added
+        table (dictof tuple: Fact): canonical form => the fact with that form
+        index (dictof str: dictof int: Fact): predicate => ID => fact, in the
+            order they were added
+        arguments (dictof str: dictof str: dictof int: Fact): predicate =>
+            first argument (None when it is a variable) => ID => fact, in the
+            order they were added
+        positions (dictof int: int): ID => position of the fact in the order
+            they were added, to merge buckets of arguments
+        added (int): number of facts added so far
+    """
+    def __init__(self):
+        """Constructor for MemoryFactStore with no facts
+        """
+        super(MemoryFactStore, self).__init__()
+        self.order = {}
+        self.table = {}
+        self.index = {}
+        self.arguments = {}
+        self.positions = {}
+        self.added = 0
+
+    def __repr__(self):
+        return 'MemoryFactStore({!r} facts)'.format(len(self.order))
+
+    def __len__(self):
+        return len(self.order)
+
+    def attach(self, kb):
+        """Start holding the facts of a KB
+
+        Args:
+            kb (KnowledgeBase): KB the facts belong to
+        """
+        pass
+
+    def objects(self):
+        """Table of registered facts and rules by ID for the SupportStore of the KB
+
+        Returns:
+            dictof int: Fact|Rule
+        """
+        return {}
+
+    def get(self, key):
+        """Fact with the given canonical form
+
+        Args:
+            key (tuple): canonical form, e.g. ('motherof', 'ada', 'bing')
+
+        Returns:
+            Fact|None
+        """
+        return self.table.get(key)
+
+    def add(self, fact):
+        """Add a fact not held yet
+
+        Args:
+            fact (Fact): registered fact being added to the KB
+        """
+        key = fact.key()
+        self.order[fact.ident] = fact
+        self.table[key] = fact
+        self.index.setdefault(key[0], {})[fact.ident] = fact
+        by_argument = self.arguments.setdefault(key[0], {})
+        by_argument.setdefault(_first_argument(key), {})[fact.ident] = fact
+        self.positions[fact.ident] = self.added
+        self.added += 1
+
+    def remove(self, fact):
+        """Remove a fact
+
+        Args:
+            fact (Fact): fact being removed from the KB
+        """
+        key = fact.key()
+        del self.order[fact.ident]
+        del self.table[key]
+        del self.index[key[0]][fact.ident]
+        del self.positions[fact.ident]
+        argument = _first_argument(key)
+        facts = self.arguments[key[0]][argument]
+        del facts[fact.ident]
+        if not facts:
+            del self.arguments[key[0]][argument]
+
+    def update(self, fact):
+        """Record that the asserted flag of a fact changed
+
+        Args:
+            fact (Fact): fact held
+        """
+        pass
+
+    def facts_for(self, statement):
+        """Facts that could match statement, in the order they were added. When
+            the first argument of statement is a constant, only the facts with
+            that first argument or a variable in its place are returned
+
+        Args:
+            statement (Statement): statement facts are matched against
+
+        Returns:
+            listof Fact
+        """
+        key = statement.key()
+        argument = _first_argument(key)
+        if argument is None:
+            return list(self.index.get(key[0], {}).values())
+        by_argument = self.arguments.get(key[0], {})
+        facts = list(by_argument.get(argument, {}).values())
+        variables = by_argument.get(None)
+        if variables:
+            facts = sorted(facts + list(variables.values()),
+                           key=lambda fact: self.positions[fact.ident])
+        return facts
+
+    def facts(self):
+        """Every fact, in the order they were added
+
+        Returns:
+            listof Fact
+        """
+        return list(self.order.values())
+
+    def keys(self):
+        """Canonical forms of every fact
+
+        Returns:
+            iterable of tuple
+        """
+        return self.table.keys()
+
+    def structures(self):
+        """Containers of the backend, for KnowledgeBase.kb_memory_report
+
+        Returns:
+            dictof str: container
+        """
+        return {'tables': self.table, 'indexes': [self.index, self.arguments, self.positions],
+                'order': self.order}
+
+    def close(self):
+        """Release the resources of the backend
+        """
+        pass
+
+# arguments of a fact kept in columns of their own, which queries filter on;
+# the others are only part of the stored canonical form
+ARGUMENTS = 4
+
+class SqliteFactStore(object):
+    """Facts held in a SQLite database, one row per fact with its predicate and
+        its first ARGUMENTS arguments in indexed columns. The constant arguments
+        of a pattern, e.g. of a kb_ask or of the next antecedent of a curried
+        rule, are matched by the query, so only the candidate facts are loaded.
+
+        Fact objects are built from their rows when needed. The cache_size facts
+        used most recently are kept in memory; the others are dropped as soon as
+        nothing refers to them, and built again, with the same ID, when needed.
+
+        The database is a working store rather than a file format: its contents
+        are replaced when it is opened, and a temporary file is used and deleted
+        on close if no path is given. A KB using it can't be pickled.
+
+        Only the facts are moved to disk. Rules, including the ones curried
+        from them, the rule table and indexes, the transitive closures along
+        with the facts they join, and the justifications and dependents in the
+        SupportStore stay in memory, so a KB whose rules derive a lot still
+        needs memory in proportion to the derivations.
+
+    Attributes:
+        path (str): database file
+        temporary (bool): flag indicating the file is deleted on close
+        cache_size (int): number of recently used facts kept in memory
+        kb (KnowledgeBase|None): KB the facts belong to
+        conn (sqlite3.Connection): connection to the database
+        cache (OrderedDict of tuple: Fact): facts used most recently by
+            canonical form, least recently used first
+        live (WeakValueDictionary of int: Fact): facts in memory by ID, so that
+            a fact is represented by one object only
+    """
+    def __init__(self, path=None, cache_size=10000):
+        """Constructor for SqliteFactStore creating an empty facts table
+
+        Args:
+            path (str|None): database file, a temporary one if None
+            cache_size (int): number of recently used facts kept in memory
+        """
+        # only imported by the KBs using this backend, keeping imports of plain
+        # KBs cheap
+        import sqlite3, tempfile
+        super(SqliteFactStore, self).__init__()
+        self.temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='kb-facts-', suffix='.db')
+            os.close(handle)
+        self.path = path
+        self.cache_size = cache_size
+        self.kb = None
+        self.cache = OrderedDict()
+        self.live = weakref.WeakValueDictionary()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # nothing has to survive a crash, the KB is rebuilt from its sources
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('DROP TABLE IF EXISTS facts')
+        columns = ''.join(', a{} TEXT'.format(i) for i in range(ARGUMENTS))
+        self.conn.execute('CREATE TABLE facts (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'ident INTEGER UNIQUE, key TEXT UNIQUE, predicate TEXT, '
+                          'arity INTEGER, ground INTEGER, asserted INTEGER' + columns + ')')
+        self.conn.execute('CREATE INDEX facts_predicate ON facts (predicate, ground)')
+        for i in range(ARGUMENTS):
+            self.conn.execute('CREATE INDEX facts_a{0} ON facts (predicate, a{0})'.format(i))
+
+    def __repr__(self):
+        return 'SqliteFactStore({!r}, {!r} facts)'.format(self.path, len(self))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM facts').fetchone()[0]
+
+    def attach(self, kb):
+        """Start holding the facts of a KB
+
+        Args:
+            kb (KnowledgeBase): KB the facts belong to
+        """
+        self.kb = kb
+
+    def objects(self):
+        """Table of registered facts and rules by ID for the SupportStore of the
+            KB, which looks facts up in the database instead of holding them
+
+        Returns:
+            MutableMapping of int: Fact|Rule
+        """
+        return _Objects(self)
+
+    def _cache(self, fact):
+        """INTERNAL USE ONLY
+        Keep a fact in memory as the most recently used one
+        """
+        key = fact.key()
+        self.cache[key] = fact
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _load(self, row):
+        """INTERNAL USE ONLY
+        Fact of a (ident, key, asserted) row, built unless it is in memory
+        """
+        ident, key, asserted = row
+        fact = self.live.get(ident)
+        if fact is None:
+            import json
+            fact = Fact(json.loads(key))
+            fact.ident = ident
+            fact.asserted = bool(asserted)
+            fact.release_supports()
+            fact.store = self.kb.store if self.kb is not None else None
+            self.live[ident] = fact
+        self._cache(fact)
+        return fact
+
+    def get(self, key):
+        fact = self.cache.get(key)
+        if fact is not None:
+            self.cache.move_to_end(key)
+            return fact
+        import json
+        row = self.conn.execute('SELECT ident, key, asserted FROM facts WHERE key = ?',
+                                (json.dumps(key),)).fetchone()
+        return self._load(row) if row else None
+
+    def by_ident(self, ident):
+        """Fact with the given ID
+
+        Args:
+            ident (int): ID of the fact in the SupportStore of the KB
+
+        Returns:
+            Fact|None
+        """
+        fact = self.live.get(ident)
+        if fact is not None:
+            self._cache(fact)
+            return fact
+        row = self.conn.execute('SELECT ident, key, asserted FROM facts WHERE ident = ?',
+                                (ident,)).fetchone()
+        return self._load(row) if row else None
+
+    def hold(self, fact):
+        """Keep a fact that isn't stored, e.g. one being registered, in memory
+
+        Args:
+            fact (Fact): fact with an ID
+        """
+        self.live[fact.ident] = fact
+        self._cache(fact)
+
+    def forget(self, ident):
+        """Drop a fact from memory
+
+        Args:
+            ident (int): ID of the fact
+        """
+        fact = self.live.pop(ident, None)
+        if fact is not None and self.cache.get(fact.key()) is fact:
+            del self.cache[fact.key()]
+
+    def add(self, fact):
+        import json
+        key = fact.key()
+        arguments = list(key[1:ARGUMENTS + 1])
+        arguments += [None] * (ARGUMENTS - len(arguments))
+        ground = all(not is_var(term) for term in key[1:])
+        self.conn.execute('INSERT INTO facts (ident, key, predicate, arity, ground, asserted' +
+                          ''.join(', a{}'.format(i) for i in range(ARGUMENTS)) + ') VALUES (' +
+                          ', '.join(['?'] * (6 + ARGUMENTS)) + ')',
+                          [fact.ident, json.dumps(key), key[0], len(key) - 1, int(ground),
+                           int(fact.asserted)] + arguments)
+        self.hold(fact)
+
+    def remove(self, fact):
+        self.conn.execute('DELETE FROM facts WHERE ident = ?', (fact.ident,))
+        if self.cache.get(fact.key()) is fact:
+            del self.cache[fact.key()]
+
+    def update(self, fact):
+        self.conn.execute('UPDATE facts SET asserted = ? WHERE ident = ?',
+                          (int(fact.asserted), fact.ident))
+
+    def facts_for(self, statement):
+        """Facts that could match statement, in the order they were added. Facts
+            with the same arguments as the constants of statement are selected
+            through the argument indexes, along with any facts containing
+            variables, which match whatever the constants are
+
+        Args:
+            statement (Statement): statement facts are matched against
+
+        Returns:
+            listof Fact
+        """
+        key = statement.key()
+        select = 'SELECT ident, key, asserted, seq FROM facts WHERE predicate = ? AND arity = ?'
+        parameters = [key[0], len(key) - 1]
+        bound = [(i, term) for i, term in enumerate(key[1:ARGUMENTS + 1]) if not is_var(term)]
+        if bound:
+            # only the first bound argument is looked up through its index, the
+            # way rules are indexed, the others are checked on the rows found
+            # (a unary + keeps SQLite from picking their less selective indexes)
+            query = (select + ' AND ground = 1' +
+                     ''.join(' AND {}a{} = ?'.format('+' if j else '', i)
+                             for j, (i, term) in enumerate(bound)) +
+                     ' UNION ALL ' + select + ' AND ground = 0 ORDER BY seq')
+            parameters = parameters + [term for i, term in bound] + parameters
+        else:
+            query = select + ' ORDER BY seq'
+        rows = self.conn.execute(query, parameters).fetchall()
+        return [self._load(row[:3]) for row in rows]
+
+    def facts(self):
+        """Every fact, in the order they were added. All of them are loaded.
+
+        Returns:
+            listof Fact
+        """
+        rows = self.conn.execute('SELECT ident, key, asserted FROM facts ORDER BY seq').fetchall()
+        return [self._load(row) for row in rows]
+
+    def keys(self):
+        """Canonical forms of every fact
+
+        Returns:
+            iterable of tuple
+        """
+        import json
+        return (tuple(json.loads(row[0])) for row in self.conn.execute('SELECT key FROM facts'))
+
+    def structures(self):
+        """Containers of the backend held in memory, for KnowledgeBase.kb_memory_report
+
+        Returns:
+            dictof str: container
+        """
+        return {'cache': self.cache}
+
+    def close(self):
+        """Close the database, deleting it if it is temporary
+        """
+        if self.conn is None:
+            return
+        self.conn.close()
+        self.conn = None
+        self.cache.clear()
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+class _Objects(MutableMapping):
+    """INTERNAL USE ONLY
+    Registered facts and rules by ID for the SupportStore of a KB whose facts
+    are in a SqliteFactStore. Rules are held here, facts are looked up in the
+    store.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.rules = {}
+
+    def __getitem__(self, ident):
+        if ident in self.rules:
+            return self.rules[ident]
+        fact = self.backend.by_ident(ident)
+        if fact is None:
+            raise KeyError(ident)
+        return fact
+
+    def __setitem__(self, ident, fact_rule):
+        if isinstance(fact_rule, Rule):
+            self.rules[ident] = fact_rule
+        else:
+            self.backend.hold(fact_rule)
+
+    def __delitem__(self, ident):
+        if self.rules.pop(ident, None) is None:
+            self.backend.forget(ident)
+
+    def __iter__(self):
+        for ident in list(self.rules):
+            yield ident
+        for row in self.backend.conn.execute('SELECT ident FROM facts'):
+            yield row[0]
+
+    def __len__(self):
+        return len(self.rules) + len(self.backend)
@@ -1,18 +1,85 @@
-import read, copy
+import time
+from collections import OrderedDict
 from util import *
 from logical_classes import *
+from support import SupportStore
+from storage import MemoryFactStore
 
 verbose = 0
 
 class KnowledgeBase(object):
-    def __init__(self, facts=[], rules=[]):
-        self.facts = facts
-        self.rules = rules
+    def __init__(self, facts=None, rules=None, count_only=False, budget=None, eviction='lru',
+                 versioned=False, agenda=False, backend=None):
+        facts = [] if facts is None else facts
+        rules = [] if rules is None else rules
+        # facts are held by the storage backend, which looks them up by
+        # canonical form and by pattern, in memory unless another one is given
+        self.backend = MemoryFactStore() if backend is None else backend
+        self.backend.attach(self)
+        # canonical form => the one Rule instance in the KB with that form, in
+        # the order rules were added
+        self.rule_table = dict((rule.key(), rule) for rule in rules)
+        # number of derivations that produced a fact/rule already in the KB
+        self.suppressed = 0
+        # predicate => first argument (None when it is a variable) => ID =>
+        # rules whose first LHS statement could match, in the order they were
+        # added
+        self.rule_index = {}
+        # the same for the RHS of every rule, transitive ones included, to
+        # look up the rules that could conclude a fact
+        self.producer_index = {}
+        self.closures = {}
+        self.closure_index = {}
+        self.store = SupportStore(self, count_only, self.backend.objects())
+        # at most budget derived facts stay materialized; cold ones are evicted
+        # ('lru' or 'lfu') and their predicates re-derived when asked about.
+        # A versioned KB keeps everything materialized so it can tag every
+        # conclusion with the versions it held in, and a KB with an agenda
+        # couldn't rematerialize on demand.
+        self.budget = None if versioned or agenda else budget
+        self.eviction = eviction
+        self.usage = OrderedDict()
+        self.partial = set()
+        # validity intervals of facts, for asking about past versions. history
+        # and changes are only imported by the KBs using them, keeping imports
+        # and construction of plain KBs cheap
+        self.history = None
+        if versioned:
+            from history import History
+            self.history = History()
+        # stream of added/removed facts, created by the first kb_subscribe
+        self.changes = None
+        # with an agenda asserts only queue rule activations, which are run
+        # by kb_run, instead of inferring everything that follows right away
+        self.agenda = None
+        if agenda:
+            from agenda import Agenda
+            self.agenda = Agenda()
+        for fact_rule in facts + rules:
+            self.store.register(fact_rule)
+            self._index(fact_rule)
+            if isinstance(fact_rule, Fact):
+                self.backend.add(fact_rule)
+            if self.history and isinstance(fact_rule, Fact):
+                self.history.added(fact_rule)
         self.ie = InferenceEngine()
 
     def __repr__(self):
         return 'KnowledgeBase({!r}, {!r})'.format(self.facts, self.rules)
 
+    @property
+    def facts(self):
+        """Facts of the KB in the order they were added, all loaded from the
+            backend if it keeps them on disk
+        """
+        return self.backend.facts()
+
+    @property
+    def rules(self):
+        """Rules of the KB in the order they were added
+        """
+        return list(self.rule_table.values())
+
     def __str__(self):
         string = "Knowledge Base: \n"
         string += "\n".join((str(fact) for fact in self.facts)) + "\n"
@@ -29,9 +96,7 @@ class KnowledgeBase(object):
         Returns:
             Fact: matching fact
         """
-        for kbfact in self.facts:
-            if fact == kbfact:
-                return kbfact
+        return self.backend.get(fact.key())
 
     def _get_rule(self, rule):
         """INTERNAL USE ONLY
@@ -43,9 +108,205 @@ class KnowledgeBase(object):
         Returns:
             Rule: matching rule
         """
-        for kbrule in self.rules:
-            if rule == kbrule:
-                return kbrule
+        return self.rule_table.get(rule.key())
+
+    def _index(self, fact_rule):
+        """INTERNAL USE ONLY
+        Add a rule to the predicate indexes, facts being indexed by the backend.
+        Transitive rules go to their TransitiveClosure instead of the rule index.
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule being added to the KB
+        """
+        if isinstance(fact_rule, Fact):
+            return
+        rhs = fact_rule.rhs
+        by_argument = self.producer_index.setdefault(rhs.predicate, {})
+        by_argument.setdefault(self._first_argument(rhs), {})[fact_rule.ident] = fact_rule
+        if TransitiveClosure.recognizes(fact_rule):
+            closure = TransitiveClosure(fact_rule)
+            self.closures[fact_rule.ident] = closure
+            for statement in fact_rule.lhs:
+                closures = self.closure_index.setdefault(statement.predicate, [])
+                if closure not in closures:
+                    closures.append(closure)
+        else:
+            first = fact_rule.lhs[0]
+            by_argument = self.rule_index.setdefault(first.predicate, {})
+            by_argument.setdefault(self._first_argument(first), {})[fact_rule.ident] = fact_rule
+
+    def _unindex(self, fact_rule):
+        """INTERNAL USE ONLY
+        Remove a fact from the closures or a rule from the predicate indexes
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule being removed from the KB
+        """
+        if isinstance(fact_rule, Fact):
+            predicate = fact_rule.statement.predicate
+            for closure in self.closure_index.get(predicate, []):
+                closure.remove_fact(fact_rule)
+            return
+        self._unindex_rule(self.producer_index, fact_rule.rhs, fact_rule)
+        if fact_rule.ident in self.closures:
+            closure = self.closures.pop(fact_rule.ident)
+            for statement in fact_rule.lhs:
+                closures = self.closure_index.get(statement.predicate, [])
+                if closure in closures:
+                    closures.remove(closure)
+        else:
+            self._unindex_rule(self.rule_index, fact_rule.lhs[0], fact_rule)
+
+    @staticmethod
+    def _first_argument(statement):
+        """INTERNAL USE ONLY
+        First argument of a statement as a rule index key, None when it is a
+        variable or missing
+        """
+        key = statement.key()
+        return key[1] if len(key) > 1 and not is_var(key[1]) else None
+
+    @staticmethod
+    def _unindex_rule(index, statement, rule):
+        """INTERNAL USE ONLY
+        Remove a rule from an index by predicate and first argument of statement
+        """
+        argument = KnowledgeBase._first_argument(statement)
+        rules = index.get(statement.predicate, {}).get(argument)
+        if rules is not None:
+            rules.pop(rule.ident, None)
+            if not rules:
+                del index[statement.predicate][argument]
+
+    def _holds(self, fact_rule):
+        """INTERNAL USE ONLY
+        Check whether this exact fact or rule object is part of the KB
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to check
+
+        Returns:
+            bool
+        """
+        if isinstance(fact_rule, Fact):
+            return self.backend.get(fact_rule.key()) is fact_rule
+        return self.rule_table.get(fact_rule.key()) is fact_rule
+
+    def _owns(self, fact_rule):
+        """INTERNAL USE ONLY
+        Check whether a fact or rule is stored by this KB itself, rather than by
+        a KB it is layered on
+        """
+        return self._holds(fact_rule)
+
+    def _asserted(self, fact_rule):
+        """INTERNAL USE ONLY
+        Whether a fact or rule in the KB counts as asserted
+        """
+        return fact_rule.asserted
+
+    def _set_retracted(self, fact_rule):
+        """INTERNAL USE ONLY
+        Mark a fact or rule in the KB as no longer asserted
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule being retracted
+        """
+        fact_rule.asserted = False
+
+    def _supports(self, fact_rule):
+        """INTERNAL USE ONLY
+        Facts and rules in the KB that fact_rule takes part in justifying
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule in the KB
+
+        Returns:
+            listof Fact|Rule
+        """
+        return self.store.supports(fact_rule)
+
+    def _producers(self, predicate, argument=None):
+        """INTERNAL USE ONLY
+        Rules concluding statements of predicate, in the order they were added
+
+        Args:
+            predicate (str): predicate of the conclusions
+            argument (str|None): first argument of the conclusions, None for
+                conclusions with any first argument
+
+        Returns:
+            listof Rule
+        """
+        by_argument = self.producer_index.get(predicate, {})
+        if argument is None:
+            rules = [rule for rules in by_argument.values() for rule in rules.values()]
+        else:
+            rules = (list(by_argument.get(argument, {}).values()) +
+                     list(by_argument.get(None, {}).values()))
+        return sorted(rules, key=lambda rule: rule.ident)
+
+    def _set_asserted(self, fact_rule):
+        """INTERNAL USE ONLY
+        Mark a fact or rule already in the KB as asserted
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule in the KB being asserted again
+        """
+        fact_rule.asserted = True
+        if isinstance(fact_rule, Fact):
+            self.backend.update(fact_rule)
+            self.usage.pop(fact_rule.key(), None)
+
+    def _closures_for(self, predicate):
+        """INTERNAL USE ONLY
+        Transitive closures with an antecedent over predicate
+
+        Args:
+            predicate (str): predicate of a fact being added
+
+        Returns:
+            listof TransitiveClosure
+        """
+        return list(self.closure_index.get(predicate, []))
+
+    def _facts_for(self, statement):
+        """INTERNAL USE ONLY
+        Facts in the KB that could match statement, in the order they were added
+
+        Args:
+            statement (Statement): statement facts are matched against
+
+        Returns:
+            listof Fact
+        """
+        return self.backend.facts_for(statement)
+
+    def _rules_for(self, fact):
+        """INTERNAL USE ONLY
+        Rules whose first LHS statement could match fact, in the order they were
+        added
+
+        Args:
+            fact (Fact): fact rules are matched against
+
+        Returns:
+            listof Rule
+        """
+        statement = fact.statement
+        by_argument = self.rule_index.get(statement.predicate)
+        if not by_argument:
+            return []
+        if statement.terms and is_var(statement.terms[0]):
+            # a fact with a variable first argument matches any first argument
+            rules = [rule for rules in by_argument.values() for rule in rules.values()]
+            return sorted(rules, key=lambda rule: rule.ident)
+        rules = list(by_argument.get(None, {}).values())
+        if statement.terms:
+            constant_rules = by_argument.get(str(statement.terms[0]))
+            if constant_rules:
+                rules = sorted(rules + list(constant_rules.values()), key=lambda rule: rule.ident)
+        return rules
 
     def kb_add(self, fact_rule):
         """Add a fact or rule to the KB
@@ -56,31 +317,52 @@ class KnowledgeBase(object):
         """
         printv("Adding {!r}", 1, verbose, [fact_rule])
         if isinstance(fact_rule, Fact):
-            if fact_rule not in self.facts:
-                self.facts.append(fact_rule)
-                for rule in self.rules:
-                    self.ie.fc_infer(fact_rule, rule, self)
+            kbfact = self._get_fact(fact_rule)
+            if kbfact is None:
+                self.store.register(fact_rule)
+                self.backend.add(fact_rule)
+                if self.budget is not None and not fact_rule.asserted:
+                    self.usage[fact_rule.key()] = 0
+                if self.history:
+                    self.history.added(fact_rule)
+                if self.changes:
+                    self.changes.publish('add', fact_rule)
+                # rules curried while the closures derive match the fact against
+                # the facts themselves, so they aren't activated again here
+                rules = self._rules_for(fact_rule)
+                for closure in self._closures_for(fact_rule.statement.predicate):
+                    self._extend(closure, fact_rule)
+                for rule in rules:
+                    self._activate(fact_rule, rule)
             else:
                 if fact_rule.supported_by:
-                    ind = self.facts.index(fact_rule)
-                    for f in fact_rule.supported_by:
-                        self.facts[ind].supported_by.append(f)
+                    for pair in fact_rule.release_supports():
+                        self.store.add_support(kbfact, pair)
                 else:
-                    ind = self.facts.index(fact_rule)
-                    self.facts[ind].asserted = True
+                    self._set_asserted(kbfact)
         elif isinstance(fact_rule, Rule):
-            if fact_rule not in self.rules:
-                self.rules.append(fact_rule)
-                for fact in self.facts:
-                    self.ie.fc_infer(fact, fact_rule, self)
+            kbrule = self._get_rule(fact_rule)
+            if kbrule is None:
+                self.rule_table[fact_rule.key()] = fact_rule
+                self.store.register(fact_rule)
+                self._index(fact_rule)
+                closure = self.closures.get(fact_rule.ident)
+                if closure:
+                    predicates = []
+                    for statement in fact_rule.lhs:
+                        if statement.predicate not in predicates:
+                            predicates.append(statement.predicate)
+                            for fact in self._facts_for(statement):
+                                self._extend(closure, fact)
+                else:
+                    for fact in self._facts_for(fact_rule.lhs[0]):
+                        self._activate(fact, fact_rule)
             else:
                 if fact_rule.supported_by:
-                    ind = self.rules.index(fact_rule)
-                    for f in fact_rule.supported_by:
-                        self.rules[ind].supported_by.append(f)
+                    for pair in fact_rule.release_supports():
+                        self.store.add_support(kbrule, pair)
                 else:
-                    ind = self.rules.index(fact_rule)
-                    self.rules[ind].asserted = True
+                    self._set_asserted(kbrule)
 
     def kb_assert(self, fact_rule):
         """Assert a fact or rule into the KB
@@ -89,26 +371,127 @@ class KnowledgeBase(object):
             fact_rule (Fact or Rule): Fact or Rule we're asserting
         """
         printv("Asserting {!r}", 0, verbose, [fact_rule])
-        self.kb_add(fact_rule)
+        if self.history:
+            with self.history.lock:
+                self.history.begin()
+                self.kb_add(fact_rule)
+                self._enforce_budget()
+                self.history.commit()
+        else:
+            self.kb_add(fact_rule)
+            self._enforce_budget()
+
+    def _activate(self, fact, rule):
+        """INTERNAL USE ONLY
+        Infer from a fact and a rule, or queue the activation on the agenda
+        """
+        if self.agenda is None:
+            self.ie.fc_infer(fact, rule, self)
+        else:
+            self.agenda.push(fact, rule)
+
+    def _extend(self, closure, fact):
+        """INTERNAL USE ONLY
+        Join a fact in a transitive closure, or queue it on the agenda as an
+        activation of the closure's rule
+        """
+        if self.agenda is None:
+            closure.add_fact(fact, self)
+        else:
+            self.agenda.push(fact, closure.rule)
+
+    def kb_run(self, max_steps=None, deadline=None):
+        """Run pending rule activations of a KB with an agenda, highest rule
+            priority first, e.g. to bound the time spent inferring per request
+
+        Args:
+            max_steps (int|None) - maximum number of activations to run
+            deadline (float|None) - time.time() after which no activation is started
+
+        Returns:
+            int - number of activations run
+        """
+        if not self.agenda:
+            return 0
+        if self.history:
+            with self.history.lock:
+                self.history.begin()
+                steps = self._run(max_steps, deadline)
+                self.history.commit()
+            return steps
+        return self._run(max_steps, deadline)
+
+    def _run(self, max_steps, deadline):
+        """INTERNAL USE ONLY
+        Body of kb_run
+        """
+        steps = 0
+        while self.agenda and (max_steps is None or steps < max_steps):
+            if deadline is not None and time.time() >= deadline:
+                break
+            fact, rule = self.agenda.pop()
+            # skip activations of facts/rules retracted while they were pending
+            if self._holds(fact) and self._holds(rule):
+                closure = self.closures.get(rule.ident)
+                if closure:
+                    closure.add_fact(fact, self)
+                else:
+                    self.ie.fc_infer(fact, rule, self)
+            steps += 1
+        return steps
+
+    def kb_saturated(self):
+        """Check whether everything that follows from the KB has been inferred
+
+        Returns:
+            bool - False if rule activations are pending on the agenda
+        """
+        return not self.agenda
+
+    def kb_version(self):
+        """Current version of a versioned KB, to be passed as as_of to kb_ask later
+
+        Returns:
+            int|None - last committed version, None if the KB isn't versioned
+        """
+        return self.history.committed if self.history else None
 
-    def kb_ask(self, fact):
+    def kb_ask(self, fact, as_of=None):
         """Ask if a fact is in the KB
 
         Args:
             fact (Fact) - Statement to be asked (will be converted into a Fact)
+            as_of (int|None) - retained version of a versioned KB to ask about,
+                e.g. kb_version() at the time or history.version_at(timestamp)
 
         Returns:
             listof Bindings|False - list of Bindings if result found, False otherwise
         """
         print("Asking {!r}".format(fact))
-        if factq(fact):
+        if factq(fact) and as_of is not None:
+            if not self.history or not self.history.oldest <= as_of <= self.history.committed:
+                print("Version not retained:", as_of)
+                return []
+            f = Fact(fact.statement)
+            bindings_lst = ListOfBindings()
+            for fact in self.history.facts_at(f.statement.predicate, as_of):
+                binding = match(f.statement, fact.statement)
+                if binding:
+                    bindings_lst.add_bindings(binding, [fact])
+
+            return bindings_lst if bindings_lst.list_of_bindings else []
+
+        elif factq(fact):
             f = Fact(fact.statement)
+            self._materialize(f.statement.predicate)
             bindings_lst = ListOfBindings()
             # ask matched facts
-            for fact in self.facts:
+            for fact in self._facts_for(f.statement):
                 binding = match(f.statement, fact.statement)
                 if binding:
                     bindings_lst.add_bindings(binding, [fact])
+                    self._touch(fact)
+            self._enforce_budget()
 
             return bindings_lst if bindings_lst.list_of_bindings else []
 
@@ -116,10 +499,105 @@ class KnowledgeBase(object):
             print("Invalid ask:", fact.statement)
             return []
 
+    def kb_subscribe(self, fact, offset=None, batch_size=None):
+        """Subscribe to the facts matching a pattern being added to or removed
+            from the KB, instead of polling kb_ask. Set kb.changes.capacity to
+            bound how far a subscription can fall behind.
+
+        Args:
+            fact (Fact) - pattern of the facts to follow
+            offset (int|None) - committed offset of an earlier subscription to
+                resume from, None to only receive changes from now on
+            batch_size (int|None) - default maximum number of changes per poll
+
+        Returns:
+            Subscription
+        """
+        from changes import ChangeLog, Subscription
+        if self.changes is None:
+            self.changes = ChangeLog()
+            self.changes.live = set(self.backend.keys())
+        log = self.changes
+        with log.condition:
+            subscription = Subscription(log, fact.statement,
+                log.end if offset is None else offset, batch_size)
+            log.subscriptions.append(subscription)
+        return subscription
+
+    def kb_ask_batch(self, facts, as_of=None):
+        """Ask about many facts at once. Queries of the same shape, i.e. with the
+            same predicate and the same arguments bound, are answered together
+            with a single pass over the facts of the predicate, looking up the
+            queries a fact can answer by their bound arguments.
+
+        Args:
+            facts (listof Fact) - Statements to be asked, e.g. (motherof X ?Y)
+                for many X
+            as_of (int|None) - retained version of a versioned KB to ask about
+
+        Returns:
+            listof (listof Bindings|False) - the answer of each query, in order,
+                as kb_ask would return it
+        """
+        print("Asking {!r} facts".format(len(facts)))
+        if as_of is not None and (not self.history or
+                                  not self.history.oldest <= as_of <= self.history.committed):
+            print("Version not retained:", as_of)
+            return [[] for fact in facts]
+        answers = [ListOfBindings() for fact in facts]
+        # shape => bound arguments => indexes of the queries
+        shapes = OrderedDict()
+        for i, fact in enumerate(facts):
+            if not factq(fact):
+                print("Invalid ask:", fact.statement)
+                continue
+            statement = fact.statement
+            bound = tuple(j for j, term in enumerate(statement.terms) if not is_var(term))
+            shape = (statement.predicate, len(statement.terms), bound)
+            values = tuple(str(statement.terms[j]) for j in bound)
+            shapes.setdefault(shape, {}).setdefault(values, []).append(i)
+
+        for (predicate, arity, bound), queries in shapes.items():
+            if as_of is not None:
+                candidates = self.history.facts_at(predicate, as_of)
+            else:
+                self._materialize(predicate)
+                if len(queries) == 1:
+                    statement = facts[next(iter(queries.values()))[0]].statement
+                else:
+                    # the backend may only return the facts matching the
+                    # arguments of the statement it is given
+                    statement = Statement([predicate] + ['?_{}'.format(j) for j in range(arity)])
+                candidates = self._facts_for(statement)
+            for candidate in candidates:
+                terms = candidate.statement.terms
+                if len(terms) != arity:
+                    continue
+                if any(is_var(terms[j]) for j in bound):
+                    # a fact with a variable in a bound position can answer
+                    # any of the queries
+                    matching = [i for group in queries.values() for i in group]
+                else:
+                    matching = queries.get(tuple(str(terms[j]) for j in bound))
+                if not matching:
+                    continue
+                for i in matching:
+                    binding = match(facts[i].statement, candidate.statement)
+                    if binding:
+                        answers[i].add_bindings(binding, [candidate])
+                        if as_of is None:
+                            self._touch(candidate)
+        self._enforce_budget()
+
+        return [answer if answer.list_of_bindings else [] for answer in answers]
+
     def kb_retract(self, fact_or_rule):
-        """Retract a fact from the KB
+        """Retract an asserted fact or rule from the KB. Everything derived from
+            it is deleted, then the conclusions that can still be derived from
+            what is left are re-derived (delete and rederive)
+
         Args:
-            fact (Fact) - Fact to be retracted
+            fact_or_rule (Fact|Rule) - Fact or Rule to be retracted
         Returns:
             None
         """
@@ -128,50 +606,384 @@ class KnowledgeBase(object):
         # Student code goes here
 
         if isinstance(fact_or_rule, Fact):
-            for fact in self.facts:
-                if fact.statement == fact_or_rule.statement:
-                    self.kb_remove(fact)
+            fact_rule = self._get_fact(fact_or_rule)
+        elif isinstance(fact_or_rule, Rule):
+            fact_rule = self._get_rule(fact_or_rule)
+        else:
+            print("Invalid retract:", fact_or_rule)
+            return
+        if fact_rule is None:
+            return
+        if self.history:
+            with self.history.lock:
+                self.history.begin()
+                self._retract(fact_rule)
+                self._enforce_budget()
+                self.history.commit()
+        else:
+            self._retract(fact_rule)
+            self._enforce_budget()
+
+    def _retract(self, fact_rule):
+        """INTERNAL USE ONLY
+        Delete and rederive (DRed). The fact or rule and everything derived from
+        it that isn't asserted is over-deleted, even if it has other support,
+        since that support may be circular. The deleted conclusions with a
+        derivation from the facts and rules left are then added back, and forward
+        chaining from them restores the rest.
 
-    def kb_remove(self, fr):
+        Args:
+            fact_rule (Fact|Rule) - asserted fact or rule in the KB
+        """
+        if not self._asserted(fact_rule):
+            return
+        if self.partial:
+            # derivations through evicted facts have to be visible
+            visited = set()
+            for predicate in list(self.partial):
+                if predicate not in visited:
+                    self._rematerialize(predicate, visited)
+        self._set_retracted(fact_rule)
+
+        deleted = [fact_rule]
+        seen = set([fact_rule.ident])
+        survivors = []
+        for fr in deleted:
+            for dependent in self._supports(fr):
+                if dependent.ident in seen:
+                    continue
+                seen.add(dependent.ident)
+                if self._asserted(dependent):
+                    survivors.append(dependent)
+                else:
+                    deleted.append(dependent)
+        for fr in deleted:
+            self._delete(fr)
+
+        # only derivations from facts and rules that were not deleted are looked
+        # up; the ones involving re-added objects are recorded by chaining
+        producers = {}
+        alternatives = []
+        for fr in deleted:
+            lhs, rhs = (fr.lhs, fr.rhs) if isinstance(fr, Rule) else ([], fr.statement)
+            key = (rhs.predicate, self._first_argument(rhs))
+            if key not in producers:
+                producers[key] = self._producers(*key)
+            pairs = self._derivations(lhs, rhs, producers[key])
+            if pairs:
+                alternatives.append((lhs, rhs, pairs))
+
+        for lhs, rhs, pairs in alternatives:
+            canonical = self._canonical(lhs, rhs)
+            if canonical is None:
+                self.kb_derive(lhs, rhs, pairs[0])
+                canonical = self._canonical(lhs, rhs)
+                pairs = pairs[1:]
+            for pair in pairs:
+                self.store.add_support(canonical, pair)
+
+        if self.store.count_only:
+            # a justification with several deleted premises was subtracted once
+            # per premise from the counts of the asserted facts it supported
+            for fr in survivors:
+                if self._owns(fr):
+                    self.store.recount(fr, self.kb_explain(fr))
+
+        for fr in deleted:
+            if isinstance(fr, Fact) and self._canonical([], fr.statement) is None:
+                if self.history:
+                    self.history.removed(fr)
+                if self.changes:
+                    self.changes.publish('remove', fr)
+
+    def _delete(self, fr):
+        """INTERNAL USE ONLY
+        Take a fact or rule out of the KB, tables, indexes and support store,
+        without removing its dependents
+
+        Args:
+            fr (Fact|Rule) - fact or rule to take out
+        """
+        self._unindex(fr)
         if isinstance(fr, Rule):
-            if len(fr.supported_by) == 0:
-                for rule in fr.supports_rules:
-                    for pair in rule.supported_by:
-                        if pair[1] == fr:
-                            rule.supported_by.remove(pair)
-                    if len(rule.supported_by) == 0:
-                        self.kb_remove(rule)
-
-                for fact in fr.supports_facts:
-                    for pair in fact.supported_by:
-                        if pair[1] == fr:
-                            fact.supported_by.remove(pair)
-                    if len(fact.supported_by) == 0:
-                        self.kb_remove(fact)
-                self.rules.remove(fr)
-            fr.asserted = False
+            del self.rule_table[fr.key()]
+        else:
+            self.backend.remove(fr)
+            self.usage.pop(fr.key(), None)
+        self.store.detach(fr)
+        self.store.unregister(fr)
+        fr.asserted = False
 
-        elif isinstance(fr, Fact):
-            if len(fr.supported_by) == 0:
-                for rule in fr.supports_rules:
-                    for pair in rule.supported_by:
-                        if pair[0] == fr:
-                            rule.supported_by.remove(pair)
-                    if len(rule.supported_by) == 0:
-                        self.kb_remove(rule)
-
-                for fact in fr.supports_facts:
-                    for pair in fact.supported_by:
-                        if pair[0] == fr:
-                            fact.supported_by.remove(pair)
-                    if len(fact.supported_by) == 0:
-                        self.kb_remove(fact)
-                self.facts.remove(fr)
+    def kb_remove(self, fr, evicting=False):
+        """Remove a fact or rule that is no longer supported, along with every
+            fact and rule that loses its last support option because of it
+
+        Args:
+            fr (Fact|Rule) - the fact or rule to be removed
+            evicting (bool) - the fact is only evicted to save memory, so the
+                predicates of removed facts are marked partially materialized
+        """
+        if isinstance(fr, Rule) or isinstance(fr, Fact):
+            if self.store.count(fr) == 0:
+                self._unindex(fr)
+                if isinstance(fr, Rule):
+                    del self.rule_table[fr.key()]
+                    if evicting:
+                        self.partial.add(fr.rhs.predicate)
+                else:
+                    self.backend.remove(fr)
+                    self.usage.pop(fr.key(), None)
+                    if evicting:
+                        self.partial.add(fr.statement.predicate)
+                    else:
+                        if self.history:
+                            self.history.removed(fr)
+                        if self.changes:
+                            self.changes.publish('remove', fr)
+                for dependent in self.store.detach(fr):
+                    if not dependent.asserted:
+                        self.kb_remove(dependent, evicting)
+                self.store.unregister(fr)
             fr.asserted = False
+            if isinstance(fr, Fact):
+                self.backend.update(fr)
 
         else:
             print("Illegal data type in kb_remove")
 
+    def _touch(self, fact):
+        """INTERNAL USE ONLY
+        Record a use of a derived fact for the eviction policy
+
+        Args:
+            fact (Fact): fact that was used
+        """
+        key = fact.key()
+        if key in self.usage:
+            self.usage[key] += 1
+            self.usage.move_to_end(key)
+
+    def _enforce_budget(self):
+        """INTERNAL USE ONLY
+        Evict cold derived facts (least recently or least frequently used) until
+        no more than budget derived facts are materialized. Facts derived from an
+        evicted fact that lose their last support are evicted along with it.
+        """
+        if self.budget is None:
+            return
+        while len(self.usage) > self.budget:
+            if self.eviction == 'lfu':
+                key = min(self.usage, key=self.usage.get)
+            else:
+                key = next(iter(self.usage))
+            printv("Evicting {!r}", 1, verbose, [key])
+            victim = self.backend.get(key)
+            self.store.drop_supports(victim)
+            self.kb_remove(victim, evicting=True)
+
+    def _dependencies(self, predicate):
+        """INTERNAL USE ONLY
+        Predicates that facts of predicate can be derived from, directly or
+        through other rules, including predicate itself
+
+        Args:
+            predicate (str): predicate to find the dependencies of
+
+        Returns:
+            listof str
+        """
+        dependencies = [predicate]
+        for current in dependencies:
+            for rule in self.rules:
+                if rule.rhs.predicate == current:
+                    for statement in rule.lhs:
+                        if statement.predicate not in dependencies:
+                            dependencies.append(statement.predicate)
+        return dependencies
+
+    def _materialize(self, predicate):
+        """INTERNAL USE ONLY
+        Rematerialize the partial predicates facts of predicate depend on,
+        before asking about it
+
+        Args:
+            predicate (str): predicate about to be asked about
+        """
+        if self.partial:
+            visited = set()
+            for dependency in self._dependencies(predicate):
+                if dependency in self.partial and dependency not in visited:
+                    self._rematerialize(dependency, visited)
+
+    def _rematerialize(self, predicate, visited=None):
+        """INTERNAL USE ONLY
+        Re-derive the evicted facts of a partially materialized predicate. The
+        predicates the producing rules depend on are rematerialized first.
+
+        Args:
+            predicate (str): predicate to rematerialize
+            visited (setof str): predicates already being rematerialized
+        """
+        visited = visited if visited is not None else set()
+        visited.add(predicate)
+        producers = self._producers(predicate)
+        for rule in producers:
+            for statement in rule.lhs:
+                if statement.predicate in self.partial and statement.predicate not in visited:
+                    self._rematerialize(statement.predicate, visited)
+        printv("Rematerializing {!r}", 1, verbose, [predicate])
+        self.partial.discard(predicate)
+        # without the justifications themselves a derivation can't be told
+        # apart from one already counted, so conclusions still in the KB are
+        # recounted instead of derived again
+        touched = {} if self.store.count_only else None
+        for rule in producers:
+            closure = self.closures.get(rule.ident)
+            if closure:
+                closure.rederive(self, touched)
+            elif self._get_rule(rule) is rule:
+                for fact in self._facts_for(rule.lhs[0]):
+                    if touched is not None:
+                        inferred = self.ie.infer(fact, rule)
+                        existing = inferred and self._canonical(*inferred)
+                        if existing:
+                            touched[existing.ident] = existing
+                            continue
+                    self.ie.fc_infer(fact, rule, self)
+        for fact_rule in (touched or {}).values():
+            self.store.recount(fact_rule, self.kb_explain(fact_rule))
+
+    def kb_memory_report(self, trace=None):
+        """Measure how the memory of the KB splits across classes, predicates,
+            asserted rules and support structures
+
+        Args:
+            trace (callable|None) - work to run under tracemalloc, e.g. asserting
+                a batch of facts, to attribute the allocations it makes to
+                fc_infer, instantiate and match
+
+        Returns:
+            MemoryReport
+        """
+        from memory import memory_report
+        return memory_report(self, trace)
+
+    def kb_explain(self, fact_rule):
+        """Recompute the justifications of a fact or rule from the KB. Used when
+            the KB only records support counts (count_only) and someone asks why.
+
+        Args:
+            fact_rule (Fact|Rule) - fact or rule in the KB to justify
+
+        Returns:
+            listof listof Fact|Rule - one list of premises per justification
+        """
+        if isinstance(fact_rule, Rule):
+            lhs, rhs = fact_rule.lhs, fact_rule.rhs
+        else:
+            lhs, rhs = [], fact_rule.statement
+        return self._derivations(lhs, rhs, self._producers(rhs.predicate, self._first_argument(rhs)))
+
+    def _derivations(self, lhs, rhs, rules):
+        """INTERNAL USE ONLY
+        Derivations of a fact (empty lhs) or rule in one step from the facts and
+        rules in the KB, whether or not it is in the KB itself
+
+        Args:
+            lhs (listof Statement): LHS statements, empty for a fact
+            rhs (Statement): RHS statement, or the statement of a fact
+            rules (listof Rule): rules to try, e.g. only the ones that could
+                conclude it
+
+        Returns:
+            listof listof Fact|Rule - one list of premises per derivation
+        """
+        key = (tuple(s.key() for s in lhs), rhs.key())
+        pairs = []
+        if not lhs:
+            fact = Fact(rhs)
+            for closure in self._closures_for(rhs.predicate):
+                pairs.extend(closure.explain(fact, self))
+        for rule in rules:
+            if len(rule.lhs) != len(lhs) + 1 or TransitiveClosure.recognizes(rule):
+                continue
+            first = self._premise(rule, lhs, rhs)
+            if first is None:
+                continue
+            for fact in self._facts_for(first):
+                inferred = self.ie.infer(fact, rule)
+                if inferred and (tuple(s.key() for s in inferred[0]), inferred[1].key()) == key:
+                    pairs.append([fact, rule])
+        return pairs
+
+    @staticmethod
+    def _premise(rule, lhs, rhs):
+        """INTERNAL USE ONLY
+        First LHS statement of rule with the variables that concluding lhs and
+        rhs would bind to constants substituted, matching every fact the rule
+        could derive them from
+
+        Args:
+            rule (Rule): rule with one more LHS statement than lhs
+            lhs (listof Statement): LHS statements, empty for a fact
+            rhs (Statement): RHS statement, or the statement of a fact
+
+        Returns:
+            Statement|None: None if the rule can't conclude them
+        """
+        bindings = {}
+        for statement, concluded in zip([rule.rhs] + rule.lhs[1:], [rhs] + lhs):
+            pattern, key = statement.key(), concluded.key()
+            if len(pattern) != len(key) or pattern[0] != key[0]:
+                return None
+            for term, value in zip(pattern[1:], key[1:]):
+                if is_var(value):
+                    continue
+                if is_var(term):
+                    if bindings.setdefault(term, value) != value:
+                        return None
+                elif term != value:
+                    return None
+        first = rule.lhs[0].key()
+        if not any(term in bindings for term in first[1:]):
+            return rule.lhs[0]
+        return Statement([first[0]] + [bindings.get(term, term) for term in first[1:]])
+
+    def _canonical(self, lhs, rhs):
+        """INTERNAL USE ONLY
+        Look up the fact (empty lhs) or rule in the KB with the given statements
+        through the canonical form tables, without building a Fact or Rule
+
+        Args:
+            lhs (listof Statement): LHS statements, empty for a fact
+            rhs (Statement): RHS statement, or the statement of a fact
+
+        Returns:
+            Fact|Rule|None: matching fact or rule
+        """
+        if lhs:
+            return self.rule_table.get((tuple(s.key() for s in lhs), rhs.key()))
+        return self.backend.get(rhs.key())
+
+    def kb_derive(self, lhs, rhs, pair):
+        """Add a fact (empty lhs) or rule derived from the premises in pair. When
+            it is already in the KB the derivation is recorded as another
+            justification of the canonical instance and no new object is built.
+
+        Args:
+            lhs (listof Statement): LHS statements, empty for a fact
+            rhs (Statement): RHS statement, or the statement of a fact
+            pair (listof Fact|Rule): premises of the derivation, e.g. [fact, rule]
+        """
+        canonical = self._canonical(lhs, rhs)
+        if canonical is not None:
+            self.store.add_support(canonical, pair)
+            self.suppressed += 1
+        elif lhs:
+            self.kb_add(Rule([lhs, rhs], [pair], pair[-1].priority))
+        else:
+            self.kb_add(Fact(rhs, [pair]))
+
 class InferenceEngine(object):
     def fc_infer(self, fact, rule, kb):
         """Forward-chaining to infer new facts and rules
@@ -187,41 +999,270 @@ class InferenceEngine(object):
         printv('Attempting to infer from {!r} and {!r} => {!r}', 1, verbose,
             [fact.statement, rule.lhs, rule.rhs])
         ####################################################
+        inferred = self.infer(fact, rule)
+        if inferred:
+            kb.kb_derive(inferred[0], inferred[1], [fact, rule])
+
+    def infer(self, fact, rule):
+        """Match a fact against the first LHS statement of a rule and instantiate
+            the statements of the fact or rule that follows
+
+        Args:
+            fact (Fact) - A fact from the KnowledgeBase
+            rule (Rule) - A rule from the KnowledgeBase
+
+        Returns:
+            (listof Statement, Statement)|None - LHS and RHS of the inferred rule
+                (LHS is empty when a fact is inferred), None if there is no match
+        """
         #create new binding by matching first left hand rule and fact
         new_binding = match(fact.statement, rule.lhs[0])
 
         if new_binding:
-             if len(rule.lhs) > 1:
-                 #start with empty lhs
-                 lhs_list = []
-                 for statement in rule.lhs[1:]:
-                     lhs_list.append(instantiate(statement, new_binding))
+             #remaining lhs is empty when a fact follows directly
+             lhs_list = [instantiate(statement, new_binding) for statement in rule.lhs[1:]]
+             return lhs_list, instantiate(rule.rhs, new_binding)
+
+class TransitiveClosure(object):
+    """Dedicated evaluator for linear recursive rules of the shape
+        ((p ?x ?y) (q ?y ?z)) -> (p ?x ?z) or ((q ?x ?y) (p ?y ?z)) -> (p ?x ?z),
+        e.g. ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z). Rather than currying one
+        intermediate Rule per matching fact, both antecedent relations are kept
+        indexed on the join value and every new edge is joined directly against
+        the other side, so the closure grows incrementally as facts arrive.
+
+        Facts with a variable in place of a join value are indexed under None
+        and joined with every fact of the other side. Joins involving such facts
+        are unified the way forward chaining through the curried rule would,
+        concluding the same facts.
+
+    Attributes:
+        rule (Rule): the recursive rule evaluated by this closure
+        left (dictof str: dictof int: Fact): facts matching the first
+            antecedent by ID, keyed by their second argument (the value they
+            join on)
+        right (dictof str: dictof int: Fact): facts matching the second
+            antecedent by ID, keyed by their first argument (the value they
+            join on)
+        sources (dictof str: dictof int: Fact): the facts in left by ID, keyed
+            by their first argument, for looking up the joins concluding a fact
+        parent (TransitiveClosure|None): closure of a base KB whose indexes are
+            joined against as well, without being modified
+    """
+    def __init__(self, rule, parent=None):
+        """Constructor for TransitiveClosure with initially empty indexes
+
+        Args:
+            rule (Rule): a rule for which TransitiveClosure.recognizes is True
+            parent (TransitiveClosure|None): closure of the base KB to share
+        """
+        super(TransitiveClosure, self).__init__()
+        self.rule = rule
+        self.left = {}
+        self.right = {}
+        self.sources = {}
+        self.parent = parent
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'TransitiveClosure({!r})'.format(self.rule)
+
+    @staticmethod
+    def recognizes(rule):
+        """Check whether a rule is linear recursive and transitive, i.e. it joins
+            two binary statements on a shared variable and concludes one of them
+
+        Args:
+            rule (Rule): rule to check
+
+        Returns:
+            bool
+        """
+        if len(rule.lhs) != 2:
+            return False
+        first, second = rule.lhs
+        for statement in (first, second, rule.rhs):
+            if len(statement.terms) != 2 or not all(is_var(t) for t in statement.terms):
+                return False
+        x, y = [str(t) for t in first.terms]
+        join, z = [str(t) for t in second.terms]
+        head = [str(t) for t in rule.rhs.terms]
+        return (len(set([x, y, z])) == 3 and y == join and head == [x, z]
+                and rule.rhs.predicate in (first.predicate, second.predicate))
+
+    @staticmethod
+    def _keys(fact):
+        """INTERNAL USE ONLY
+        First and second argument of a binary fact as index keys, None for a
+        variable
+        """
+        return [None if is_var(term) else term for term in fact.key()[1:]]
+
+    @staticmethod
+    def _ground(key):
+        """INTERNAL USE ONLY
+        Check whether the canonical form of a binary fact has no variables
+        """
+        return not (is_var(key[1]) or is_var(key[2]))
+
+    def add_fact(self, fact, kb):
+        """Index a fact and derive every conclusion it produces when joined with
+            the facts already indexed
+
+        Args:
+            fact (Fact): fact newly added to the KB
+            kb (KnowledgeBase): KB that derived facts are added to
+        """
+        statement = fact.statement
+        if len(statement.terms) != 2:
+            return
+        first, second = self.rule.lhs
+        source, target = self._keys(fact)
+        if statement.predicate == first.predicate:
+            self.left.setdefault(target, {})[fact.ident] = fact
+            self.sources.setdefault(source, {})[fact.ident] = fact
+            for other in self.joinable('right', target, kb):
+                self._derive(fact, other, kb)
+        if statement.predicate == second.predicate:
+            self.right.setdefault(source, {})[fact.ident] = fact
+            for other in self.joinable('left', source, kb):
+                self._derive(other, fact, kb)
+
+    def joinable(self, side, join, kb):
+        """Facts on one side of the join that can join on the given value,
+            including the ones indexed by the parent closure that are still in
+            kb. Facts with a variable there join on any value, and every fact
+            joins on a variable (None).
+
+        Args:
+            side (str): 'left', 'right' or 'sources'
+            join (str|None): join value, or source value for 'sources'
+            kb (KnowledgeBase): KB the facts have to be part of
+
+        Returns:
+            listof Fact
+        """
+        index = getattr(self, side)
+        if join is None:
+            facts = [fact for facts in index.values() for fact in facts.values()]
+        else:
+            facts = list(index.get(join, {}).values())
+            if None in index:
+                facts += list(index[None].values())
+        if self.parent is not None:
+            facts = [f for f in self.parent.joinable(side, join, kb) if kb._holds(f)] + facts
+        return facts
+
+    def remove_fact(self, fact):
+        """Drop a fact from the indexes once it has been removed from the KB
+
+        Args:
+            fact (Fact): fact removed from the KB
+        """
+        if len(fact.statement.terms) != 2:
+            return
+        source, target = self._keys(fact)
+        for index, key in ((self.left, target), (self.right, source), (self.sources, source)):
+            facts = index.get(key)
+            if facts and facts.get(fact.ident) is fact:
+                del facts[fact.ident]
+                if not facts:
+                    del index[key]
 
-                 #make a rule by combining the new lhs and given rhs
-                 new_rhs = instantiate(rule.rhs, new_binding)
-                 inferred_r = Rule([lhs_list, new_rhs])
+    def explain(self, fact, kb):
+        """Recompute the justifications this closure provides for a fact
 
-                 #rule and fact have inferred rule as dependent
-                 rule.supports_rules.append(inferred_r)
-                 fact.supports_rules.append(inferred_r)
+        Args:
+            fact (Fact): fact to justify
+            kb (KnowledgeBase): KB the premises have to be part of
 
-                 #inferred rule is supported by provided rule and fact
-                 inferred_r.supported_by.append([fact, rule])
+        Returns:
+            listof listof Fact|Rule: [left fact, right fact, rule] per justification
+        """
+        statement = fact.statement
+        if statement.predicate != self.rule.rhs.predicate or len(statement.terms) != 2:
+            return []
+        key = statement.key()
+        source = self._keys(fact)[0]
+        pairs = []
+        for left_fact in self.joinable('sources', source, kb):
+            left = left_fact.key()
+            ground = self._ground(left)
+            if ground and left[1] != key[1]:
+                continue
+            for right_fact in self.joinable('right', None if is_var(left[2]) else left[2], kb):
+                right = right_fact.key()
+                if ground and self._ground(right):
+                    # right_fact was found under the join value of left_fact
+                    joined = right[2] == key[2]
+                else:
+                    conclusion = self._conclusion(left_fact, right_fact)
+                    joined = conclusion is not None and conclusion.key() == key
+                if joined:
+                    pairs.append([left_fact, right_fact, self.rule])
+        return pairs
+
+    def rederive(self, kb, touched=None):
+        """Join everything indexed again, re-adding conclusions that were evicted
+
+        Args:
+            kb (KnowledgeBase): KB that derived facts are added to
+            touched (dictof int: Fact|None): when given, conclusions still in
+                the KB are collected here by ident instead of being derived again
+        """
+        for join, left_facts in list(self.left.items()):
+            if join is None:
+                right_facts = [f for facts in self.right.values() for f in facts.values()]
+            else:
+                right_facts = (list(self.right.get(join, {}).values()) +
+                               list(self.right.get(None, {}).values()))
+            for left_fact in list(left_facts.values()):
+                for right_fact in right_facts:
+                    if touched is not None:
+                        conclusion = self._conclusion(left_fact, right_fact)
+                        existing = conclusion and kb._canonical([], conclusion)
+                        if existing:
+                            touched[existing.ident] = existing
+                            continue
+                    self._derive(left_fact, right_fact, kb)
 
-                 #add inferred rule to KnowledgeBase
-                 kb.kb_add(inferred_r)
+    def _derive(self, left_fact, right_fact, kb):
+        """INTERNAL USE ONLY
+        Add the conclusion of joining left_fact and right_fact to the KB. The
+        justification records both premises alongside the rule.
 
-             else:
-                 #derive fact by matching first lhs with provided fact
-                 new_fact = instantiate(rule.rhs, new_binding)
-                 inferred_f = Fact(new_fact)
+        Args:
+            left_fact (Fact): fact matching the first antecedent
+            right_fact (Fact): fact matching the second antecedent
+            kb (KnowledgeBase): KB to add the derived fact to
+        """
+        conclusion = self._conclusion(left_fact, right_fact)
+        if conclusion is not None:
+            kb.kb_derive([], conclusion, [left_fact, right_fact, self.rule])
 
-                 #rule and fact have inferred fact as dependent
-                 fact.supports_facts.append(inferred_f)
-                 rule.supports_facts.append(inferred_f)
+    def _conclusion(self, left_fact, right_fact):
+        """INTERNAL USE ONLY
+        Statement concluded by joining left_fact and right_fact. Facts with
+        variables are matched against the rule as fc_infer would, first the
+        left one, then the right one against the curried second antecedent.
 
-                 ##inferred fact is supported by provided rule and fact
-                 inferred_f.supported_by.append([[fact,rule]])
+        Args:
+            left_fact (Fact): fact matching the first antecedent
+            right_fact (Fact): fact matching the second antecedent
 
-                 #add inferred fact to kb
-                 kb.kb_add(inferred_f)
\ No newline at end of file
+        Returns:
+            Statement|None: None if the facts don't join
+        """
+        left, right = left_fact.key(), right_fact.key()
+        if self._ground(left) and self._ground(right):
+            if left[2] != right[1]:
+                return None
+            return Statement([self.rule.rhs.predicate, left[1], right[2]])
+        bindings = match(left_fact.statement, self.rule.lhs[0])
+        if not bindings:
+            return None
+        second = instantiate(self.rule.lhs[1], bindings)
+        rhs = instantiate(self.rule.rhs, bindings)
+        bindings = match(right_fact.statement, second)
+        return instantiate(rhs, bindings) if bindings else None
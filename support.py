@@ -0,0 +1,297 @@
+from array import array
+import itertools
+
+# identifiers are handed out globally so that a fact or rule keeps the same ID
+# in every store it is registered with
+_next_ident = itertools.count()
+
+# every justification is stored as a fixed width record of premise IDs, padded
+# with NO_PREMISE, e.g. [fact, rule] => (fact_id, rule_id, NO_PREMISE)
+WIDTH = 3
+NO_PREMISE = -1
+
+def _advance_idents(ident):
+    """INTERNAL USE ONLY
+    Move the identifier counter past ident, e.g. one restored from a pickle
+    written by another process
+    """
+    global _next_ident
+    current = next(_next_ident)
+    _next_ident = itertools.count(max(current, ident + 1))
+
+class SupportStore(object):
+    """Compact storage for the justifications of the facts and rules in a
+        KnowledgeBase. Facts and rules are registered under integer IDs and
+        every support option is kept as a record of premise IDs in an array,
+        instead of as Python lists of objects hanging off every fact and rule.
+
+        With count_only set the premises of a justification are not recorded at
+        all, only how many justifications each fact/rule has. Full justifications
+        are then recomputed from the KB on demand (see KnowledgeBase.kb_explain).
+
+    Attributes:
+        kb (KnowledgeBase): KB used to recompute justifications in count_only mode
+        count_only (bool): flag indicating only support counts are recorded
+        objects (dictof int: Fact|Rule): registered facts and rules by ID
+        justifications (dictof int: array): flat arrays of premise IDs, WIDTH per
+            justification, for each supported fact/rule (unused in count_only mode)
+        counts (dictof int: int): number of justifications of each supported fact/rule
+        dependents (dictof int: array): IDs of the facts/rules each premise
+            supports, once per justification it takes part in. IDs of dropped
+            justifications are only pruned once the array doubles in length.
+        limits (dictof int: int): length of the dependents array of a premise
+            at which it is pruned next
+    """
+    def __init__(self, kb=None, count_only=False, objects=None):
+        """Constructor for SupportStore creating initially empty tables
+
+        Args:
+            kb (KnowledgeBase): KB used to recompute justifications on demand
+            count_only (bool): only record support counts
+            objects (MutableMapping|None): table to register facts and rules
+                in, e.g. one looking facts up in the storage backend of the KB
+        """
+        super(SupportStore, self).__init__()
+        self.kb = kb
+        self.count_only = count_only
+        self.objects = {} if objects is None else objects
+        self.justifications = {}
+        self.counts = {}
+        self.dependents = {}
+        self.limits = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'SupportStore({!r} objects, count_only={!r})'.format(
+                len(self.objects), self.count_only)
+
+    def __setstate__(self, state):
+        """Restore a pickled store. The identifier counter starts over in a new
+        process, so it is moved past the identifiers restored.
+        """
+        self.__dict__.update(state)
+        _advance_idents(max(itertools.chain(self.objects, self.counts, self.dependents),
+                            default=NO_PREMISE))
+
+    def __contains__(self, fact_rule):
+        """Define behavior of in, i.e. whether fact_rule is registered here
+        """
+        return fact_rule.ident is not None and self.objects.get(fact_rule.ident) is fact_rule
+
+    def register(self, fact_rule):
+        """Register a fact or rule with the store, moving the support options it
+            was constructed with into the store
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule being added to the KB
+        """
+        if fact_rule.ident is None:
+            fact_rule.ident = next(_next_ident)
+        self.objects[fact_rule.ident] = fact_rule
+        pending = fact_rule.release_supports()
+        fact_rule.store = self
+        for pair in pending:
+            self.add_support(fact_rule, pair)
+
+    def unregister(self, fact_rule):
+        """Forget a fact or rule removed from the KB
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule removed from the KB
+        """
+        ident = fact_rule.ident
+        self.drop_supports(fact_rule)
+        self.objects.pop(ident, None)
+        self.dependents.pop(ident, None)
+        self.limits.pop(ident, None)
+        if fact_rule.store is self:
+            fact_rule.store = None
+
+    def add_support(self, fact_rule, pair):
+        """Record one justification of fact_rule
+
+        Args:
+            fact_rule (Fact|Rule): registered fact or rule being supported
+            pair (listof Fact|Rule): premises of the justification, e.g. [fact, rule]
+        """
+        premises = []
+        for premise in pair:
+            if premise.ident is None:
+                premise.ident = next(_next_ident)
+                self.objects[premise.ident] = premise
+            if premise.ident not in premises:
+                premises.append(premise.ident)
+        record = premises + [NO_PREMISE] * (WIDTH - len(premises))
+
+        ident = fact_rule.ident
+        self.objects.setdefault(ident, fact_rule)
+        if not self.count_only:
+            flat = self.justifications.setdefault(ident, array('l'))
+            for i in range(0, len(flat), WIDTH):
+                if flat[i:i + WIDTH].tolist() == record:
+                    return
+            flat.extend(record)
+        self.counts[ident] = self.counts.get(ident, 0) + 1
+        for premise in premises:
+            dependents = self.dependents.setdefault(premise, array('l'))
+            dependents.append(ident)
+            if len(dependents) > self.limits.get(premise, 64):
+                self._prune(premise)
+
+    def _depends(self, ident, premise):
+        """INTERNAL USE ONLY
+        Check whether the fact/rule with ID ident still has a justification
+        involving premise, as far as the store knows in count_only mode
+        """
+        if self.count_only:
+            return ident in self.counts
+        flat = self.justifications.get(ident)
+        return flat is not None and premise in flat
+
+    def _prune(self, premise):
+        """INTERNAL USE ONLY
+        Drop the IDs of dependents whose justifications involving premise were
+        dropped from its dependents array, and double the length at which it is
+        pruned next, keeping the cost per justification constant
+        """
+        kept = array('l', [d for d in self.dependents[premise] if self._depends(d, premise)])
+        self.dependents[premise] = kept
+        self.limits[premise] = max(64, 2 * len(kept))
+
+    def _unlink(self, premise, ident, times):
+        """INTERNAL USE ONLY
+        Remove ident from the dependents array of premise as many times as
+        justifications of ident involving premise were dropped
+        """
+        dependents = self.dependents.get(premise)
+        if dependents is None:
+            return
+        kept = array('l')
+        for dependent in dependents:
+            if dependent == ident and times > 0:
+                times -= 1
+            else:
+                kept.append(dependent)
+        self.dependents[premise] = kept
+
+    def count(self, fact_rule):
+        """Number of justifications recorded for fact_rule
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to count justifications of
+
+        Returns:
+            int
+        """
+        return self.counts.get(fact_rule.ident, 0)
+
+    def recount(self, fact_rule, pairs):
+        """Set the justifications of fact_rule in count_only mode, e.g. to the
+            ones recomputed by KnowledgeBase.kb_explain after several of its
+            premises were removed together. The premises list fact_rule among
+            their dependents once per justification they take part in.
+
+        Args:
+            fact_rule (Fact|Rule): registered fact or rule
+            pairs (listof listof Fact|Rule): premises of every justification
+        """
+        ident = fact_rule.ident
+        if pairs:
+            self.counts[ident] = len(pairs)
+        else:
+            self.counts.pop(ident, None)
+        needed = {}
+        for pair in pairs:
+            for premise in pair:
+                needed[premise.ident] = needed.get(premise.ident, 0) + 1
+        for premise, times in needed.items():
+            dependents = self.dependents.setdefault(premise, array('l'))
+            recorded = dependents.count(ident)
+            if recorded < times:
+                dependents.extend([ident] * (times - recorded))
+            elif recorded > times:
+                self._unlink(premise, ident, recorded - times)
+
+    def drop_supports(self, fact_rule):
+        """Drop every justification of fact_rule, leaving it unsupported
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to drop the justifications of
+        """
+        self.justifications.pop(fact_rule.ident, None)
+        self.counts.pop(fact_rule.ident, None)
+
+    def detach(self, premise):
+        """Drop every justification premise takes part in
+
+        Args:
+            premise (Fact|Rule): fact or rule that is being removed from the KB
+
+        Returns:
+            listof Fact|Rule: dependents left without any justification
+        """
+        orphans = []
+        multiplicity = {}
+        for ident in self.dependents.pop(premise.ident, ()):
+            if ident not in multiplicity:
+                multiplicity[ident] = 0
+            multiplicity[ident] += 1
+        for ident in multiplicity:
+            if ident not in self.counts:
+                continue
+            if self.count_only:
+                self.counts[ident] -= multiplicity[ident]
+            else:
+                flat = self.justifications[ident]
+                kept = array('l')
+                for i in range(0, len(flat), WIDTH):
+                    if premise.ident not in flat[i:i + WIDTH]:
+                        kept.extend(flat[i:i + WIDTH])
+                self.justifications[ident] = kept
+                self.counts[ident] = len(kept) // WIDTH
+            if self.counts[ident] <= 0:
+                self.counts.pop(ident)
+                self.justifications.pop(ident, None)
+                orphans.append(self.objects[ident])
+        return orphans
+
+    def supported_by(self, fact_rule):
+        """Materialize the justifications of fact_rule as lists of premises
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to justify
+
+        Returns:
+            listof listof Fact|Rule: one list of premises per justification
+        """
+        if fact_rule.ident not in self.counts:
+            return []
+        if self.count_only:
+            return self.kb.kb_explain(fact_rule)
+        flat = self.justifications[fact_rule.ident]
+        pairs = []
+        for i in range(0, len(flat), WIDTH):
+            pairs.append([self.objects[ident] for ident in flat[i:i + WIDTH]
+                          if ident != NO_PREMISE])
+        return pairs
+
+    def supports(self, fact_rule):
+        """Facts and rules that fact_rule takes part in justifying
+
+        Args:
+            fact_rule (Fact|Rule): premise to look up
+
+        Returns:
+            listof Fact|Rule: distinct dependents in the order they were recorded
+        """
+        dependents = []
+        seen = set()
+        for ident in self.dependents.get(fact_rule.ident, ()):
+            if ident in seen or not self._depends(ident, fact_rule.ident):
+                continue
+            seen.add(ident)
+            dependent = self.objects.get(ident)
+            if dependent is not None:
+                dependents.append(dependent)
+        return dependents
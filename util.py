@@ -59,6 +59,45 @@ def match_recursive(terms1, terms2, bindings):  # recursive...
         return False
     return match_recursive(terms1[1:], terms2[1:], bindings)
 
+def match_keys(key1, key2, bindings=None):
+    """Match the canonical forms of two statements the way match does, e.g. to
+        compute with facts shipped or stored as keys
+
+    Args:
+        key1 (tuple): canonical form to match with key2, e.g. ('isa', '?x', 'block')
+        key2 (tuple): canonical form to match with key1
+        bindings (dict|None): variable => value bindings already associated
+
+    Returns:
+        dict|None: the bindings extended so that both match, None if they don't
+    """
+    if len(key1) != len(key2) or key1[0] != key2[0]:
+        return None
+    bindings = dict(bindings) if bindings else {}
+    for term1, term2 in zip(key1[1:], key2[1:]):
+        if is_var(term1):
+            if bindings.setdefault(term1, term2) != term2:
+                return None
+        elif is_var(term2):
+            if bindings.setdefault(term2, term1) != term1:
+                return None
+        elif term1 != term2:
+            return None
+    return bindings
+
+def instantiate_key(key, bindings):
+    """Canonical form of a statement with the bound variables substituted, the
+        counterpart of instantiate for match_keys
+
+    Args:
+        key (tuple): canonical form of the statement
+        bindings (dict): variable => value bindings, e.g. from match_keys
+
+    Returns:
+        tuple
+    """
+    return tuple(bindings.get(term, term) for term in key)
+
 def instantiate(statement, bindings):
     """Generate Statement from given statement and bindings. Constructed statement
         has bound values for variables if they exist in bindings.
@@ -88,7 +127,7 @@ def factq(element):
     """
     return isinstance(element, lc.Fact)
 
-def printv(message, level, verbose, data=[]):
+def printv(message, level, verbose, data=None):
     """Prints given message formatted with data if passed in verbose flag is greater than level
 
     Args: